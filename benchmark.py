@@ -0,0 +1,388 @@
+#!/usr/bin/env python3
+
+from datetime import timedelta
+from pathlib import Path
+from time import perf_counter
+
+from PIL import Image, ImageEnhance
+
+import prepare_brightness
+import prepare_colourspace
+from prepare_background import prepare_background, visual_difference
+from prepare_brightness import percv_brightness, threshold, get_modified
+
+
+def legacy_get_modified(im, make_brighter):
+    # the 1.05x search loop get_modified used to run, kept for comparison
+    bg_enhancer = ImageEnhance.Brightness(im)
+
+    new_brightness = percv_brightness(im)
+    bg_enhanced = im
+    factor = 1.0
+    if make_brighter:
+        while new_brightness <= prepare_brightness.target_brighter:
+            bg_enhanced = bg_enhancer.enhance(factor)
+            new_brightness = percv_brightness(bg_enhanced)
+            factor = factor * 1.05
+    else:
+        while new_brightness >= prepare_brightness.target_darker:
+            bg_enhanced = bg_enhancer.enhance(factor)
+            new_brightness = percv_brightness(bg_enhanced)
+            factor = factor / 1.05
+    return bg_enhanced
+
+
+def synthetic_image(size, level=1.0):
+    r = Image.linear_gradient('L').resize(size)
+    g = Image.radial_gradient('L').resize(size)
+    b = Image.effect_noise(size, 64)
+    im = Image.merge('RGB', (r, g, b))
+    return ImageEnhance.Brightness(im).enhance(level)
+
+
+def timed(func, *args):
+    start = perf_counter()
+    result = func(*args)
+    return perf_counter() - start, result
+
+
+def summary(samples):
+    # per-call latencies in seconds -> milliseconds for the JSON report
+    ordered = sorted(samples)
+    return {'calls': len(ordered), 'mean_ms': sum(ordered) / len(ordered) * 1000,
+            'p95_ms': ordered[int(len(ordered) * 0.95)] * 1000, 'max_ms': ordered[-1] * 1000}
+
+
+def bench_brightness(size):
+    print(f'brightness targeting on {size[0]}x{size[1]}')
+    results = {}
+    for level in (0.3, 1.0, 1.4):
+        im = synthetic_image(size, level)
+        make_bright = threshold(im)
+        t_legacy, legacy = timed(legacy_get_modified, im, make_bright)
+        t_solved, solved = timed(get_modified, im, make_bright)
+        print(f'  level {level}: {"brighter" if make_bright else "darker"}, '
+              f'loop {t_legacy:.2f}s -> {percv_brightness(legacy):.1f}, '
+              f'solver {t_solved:.2f}s -> {percv_brightness(solved):.1f}')
+        results[str(level)] = {'brighter': make_bright, 'loop_s': t_legacy, 'solver_s': t_solved,
+                               'loop_brightness': percv_brightness(legacy),
+                               'solver_brightness': percv_brightness(solved)}
+    return results
+
+
+def legacy_prepare_background(src):
+    # full resolution brightness work first, resize afterwards
+    bg = Image.open(src)
+    if_brighter = threshold(bg)
+    return prepare_colourspace.prepare(get_modified(bg, if_brighter)), if_brighter
+
+
+def bench_pipeline(size):
+    import tempfile
+
+    print(f'background pipeline on a {size[0]}x{size[1]} JPEG')
+    results = {}
+    with tempfile.TemporaryDirectory() as tmp:
+        for level in (0.3, 1.0):
+            src = f'{tmp}/{level}.jpg'
+            synthetic_image(size, level).save(src, quality=90)
+            t_legacy, (legacy, _) = timed(legacy_prepare_background, src)
+            t_new, (new, _) = timed(prepare_background, src)
+            difference = visual_difference(legacy, new)
+            print(f'  level {level}: legacy {t_legacy:.2f}s, downscale first {t_new:.2f}s, '
+                  f'difference {difference:.3f}')
+            results[str(level)] = {'legacy_s': t_legacy, 'downscale_first_s': t_new, 'difference': difference}
+    return results
+
+
+def legacy_quantize(img):
+    # PIL's generic quantize against the 256 entry palette, what prepare_colourspace used to do
+    pal_img = Image.new('P', (1, 1))
+    pal_img.putpalette(prepare_colourspace.palette)
+    return img.convert('RGB').quantize(palette=pal_img)
+
+
+def bench_quantize(repeat=5):
+    img = synthetic_image(prepare_colourspace.size)
+    print(f'quantize {img.size[0]}x{img.size[1]}, best of {repeat}, quality as blurred difference to the input')
+    candidates = [('PIL quantize', legacy_quantize)]
+    candidates += [(dither, lambda im, dither=dither: prepare_colourspace.quantize(im, dither))
+                   for dither in prepare_colourspace.dithers]
+    results = {}
+    for label, func in candidates:
+        best = min(timed(func, img)[0] for _ in range(repeat))
+        difference = visual_difference(img, func(img))
+        print(f'  {label}: {best * 1000:.1f} ms, difference {difference:.3f}')
+        results[label] = {'best_ms': best * 1000, 'difference': difference}
+    return results
+
+
+class FakeInky:
+    # stands in for InkyWHAT, so show() goes through the hardware path instead of opening a viewer
+    WIDTH, HEIGHT = prepare_colourspace.size
+    WHITE, BLACK, RED = 0, 1, 2
+
+    def __init__(self):
+        self.image = None
+        self.border = None
+        self.shows = 0
+
+    def set_border(self, colour):
+        self.border = colour
+
+    def set_image(self, image):
+        self.image = image.copy()
+
+    def show(self, busy_wait=True):
+        self.shows += 1
+
+
+class FakeWeather:
+    def __init__(self, now, humidity=50, temperature=21.37, status='zachmurzenie umiarkowane'):
+        self.now = now
+        self.humidity = humidity
+        self.temperature = temperature
+        self.status = status
+
+    def get_reference_time(self):
+        return int(self.now.timestamp())
+
+    def get_sunrise_time(self):
+        return int(self.now.replace(hour=6, minute=12).timestamp())
+
+    def get_sunset_time(self):
+        return int(self.now.replace(hour=19, minute=48).timestamp())
+
+    def get_detailed_status(self):
+        return self.status
+
+    def get_temperature(self, unit):
+        return {'temp': self.temperature}
+
+    def get_humidity(self):
+        return self.humidity
+
+
+class FakeObservation:
+    def __init__(self, weather):
+        self.weather = weather
+
+    def get_reception_time(self):
+        return self.weather.get_reference_time()
+
+    def get_weather(self):
+        return self.weather
+
+
+class FakeOWM:
+    def __init__(self, weather):
+        self.weather = weather
+
+    def weather_at_coords(self, lat, lon):
+        return FakeObservation(self.weather)
+
+
+def headless_papierek(weather):
+    import main
+    from weather_provider import WeatherProvider
+
+    main.owm = FakeOWM(weather)
+    main.weather = WeatherProvider(main.owm, cache_path=None)
+    main.Papierek.try_real_hw = staticmethod(FakeInky)
+    papierek = main.Papierek(coords=(52.23, 21.01))
+    main.weather.refresh(papierek.coords)
+    return papierek
+
+
+def bench_update_canvas(ticks):
+    from datetime import datetime
+
+    papierek = headless_papierek(FakeWeather(datetime.now()))
+    print(f'update_canvas, {ticks} ticks')
+    results = {}
+    for label, invalidate in (('redraw everything', True), ('cached layers', False)):
+        start = perf_counter()
+        for _ in range(ticks):
+            if invalidate:
+                papierek.invalidate_layers()
+            papierek.update_canvas()
+        per_tick = (perf_counter() - start) / ticks
+        print(f'  {label}: {per_tick * 1000:.2f} ms per tick')
+        results[label] = {'ticks': ticks, 'per_tick_ms': per_tick * 1000}
+    return results
+
+
+# one value from each humidity description weather_runs picks from
+humidity_buckets = (10, 25, 35, 50, 60, 70, 80, 90, 95)
+
+
+def sun_branch(weather, time_now):
+    # which of the sunrise/sunset texts weather_runs will draw at time_now
+    sunrise = weather.now.replace(hour=6, minute=12)
+    sunset = weather.now.replace(hour=19, minute=48)
+    if time_now < sunrise:
+        return 'before sunrise'
+    if time_now < sunset:
+        return 'daytime' if sunset - time_now > timedelta(hours=1) else 'last hour of daylight'
+    return 'evening' if time_now - sunset > timedelta(hours=1) else 'first hour after sunset'
+
+
+def bench_simulated_days(days=2, step_minutes=20):
+    # the display loop over whole simulated days: every sun branch, humidity bucket and theme
+    from datetime import datetime
+
+    import main
+
+    day = datetime.now().replace(hour=0, minute=0, second=0, microsecond=0)
+    weather = FakeWeather(day)
+    papierek = headless_papierek(weather)
+    themes = {'no background': (None, True)}
+    for label, level in (('bright background', 1.4), ('dark background', 0.3)):
+        bg = synthetic_image(prepare_colourspace.size, level)
+        themes[label] = (prepare_colourspace.quantize(bg), threshold(bg))
+
+    steps = days * 24 * 60 // step_minutes
+    print(f'simulated days: {days} days in {step_minutes} min steps, {len(humidity_buckets)} humidity buckets, '
+          f'{len(themes)} themes')
+    results = {}
+    for theme, (bg, bright) in themes.items():
+        papierek.set_bg(bg, bright)
+        renders, shows, branches = [], [], {}
+        for humidity in humidity_buckets:
+            for step in range(steps):
+                time_now = day + timedelta(minutes=step * step_minutes)
+                weather.now = time_now.replace(hour=0, minute=0)
+                weather.humidity = humidity
+                main.weather.refresh(papierek.coords)
+                start = perf_counter()
+                papierek.update_canvas(time_now)
+                renders.append(perf_counter() - start)
+                branch = sun_branch(weather, time_now)
+                branches[branch] = branches.get(branch, 0) + 1
+                start = perf_counter()
+                papierek.show()
+                shows.append(perf_counter() - start)
+        results[theme] = {'update_canvas': summary(renders), 'show': summary(shows), 'sun_branches': branches}
+        print(f'  {theme}: update_canvas mean {results[theme]["update_canvas"]["mean_ms"]:.2f} ms, '
+              f'p95 {results[theme]["update_canvas"]["p95_ms"]:.2f} ms; '
+              f'show mean {results[theme]["show"]["mean_ms"]:.2f} ms; '
+              + ', '.join(f'{branch} {count}' for branch, count in branches.items()))
+    results['display'] = {'shows': papierek.inky_display.shows, 'refreshes_avoided': papierek.refreshes_avoided}
+    return results
+
+
+prepare_snippet = """
+import sys
+from time import perf_counter
+from prepare_background import prepare_background
+
+def peak_kb():
+    # VmHWM starts over at exec, unlike ru_maxrss which a child inherits from the benchmark process
+    with open('/proc/self/status') as f:
+        return next(int(line.split()[1]) for line in f if line.startswith('VmHWM:'))
+
+before = peak_kb()
+start = perf_counter()
+prepare_background(sys.argv[1])
+print(perf_counter() - start, before, peak_kb())
+"""
+
+# synthetic upload corpus, from a small phone screenshot to a 24 MP camera
+prepare_sizes = ((640, 480), (1600, 1200), (4000, 3000), (6000, 4000))
+
+
+def bench_prepare_background(sizes=prepare_sizes):
+    # what an upload costs: each JPEG prepared in a fresh process, so the peak RSS belongs to it alone
+    import subprocess
+    import sys
+    import tempfile
+
+    cwd = Path(__file__).parent.absolute()
+    print('prepare_background on synthetic JPEGs, each in a fresh process')
+    results = {}
+    with tempfile.TemporaryDirectory() as tmp:
+        for size in sizes:
+            src = f'{tmp}/{size[0]}x{size[1]}.jpg'
+            synthetic_image(size).save(src, quality=90)
+            result = subprocess.run([sys.executable, '-c', prepare_snippet, src], cwd=cwd,
+                                    capture_output=True, text=True, check=True)
+            seconds, before_kb, peak_kb = result.stdout.strip().splitlines()[-1].split()
+            label = f'{size[0]}x{size[1]}'
+            results[label] = {'latency_s': float(seconds), 'peak_rss_mb': int(peak_kb) / 1024,
+                              'peak_growth_mb': (int(peak_kb) - int(before_kb)) / 1024}
+            print(f'  {label}: {float(seconds):.2f}s, peak RSS {results[label]["peak_rss_mb"]:.0f} MB '
+                  f'(+{results[label]["peak_growth_mb"]:.0f} MB while preparing)')
+    return results
+
+
+first_frame_snippet = """
+import main
+from time import perf_counter
+papierek = main.Papierek(coords=(52.23, 21.01))
+papierek.update_canvas()
+print(perf_counter() - main.started)
+"""
+
+
+def bench_startup(repeat=3):
+    # cold start of the display: module imports (-X importtime) and time to the first rendered frame
+    import subprocess
+    import sys
+
+    cwd = Path(__file__).parent.absolute()
+    print('startup')
+    result = subprocess.run([sys.executable, '-X', 'importtime', '-c', 'import main'], cwd=cwd,
+                            capture_output=True, text=True)
+    total_us, children, main_children = 0, [], []
+    for line in result.stderr.splitlines():
+        if not line.startswith('import time:') or 'cumulative' in line:
+            continue
+        self_us, cumulative_us, name = line[len('import time:'):].split('|')
+        depth = (len(name) - len(name.lstrip()) - 1) // 2
+        if depth == 0:
+            # a top level import, its children were listed right before it
+            total_us += int(cumulative_us)
+            if name.strip() == 'main':
+                main_children = children
+            children = []
+        elif depth == 1:
+            children.append((int(cumulative_us), name.strip()))
+    main_children.sort(reverse=True)
+    print(f'  import main: {total_us / 1000:.1f} ms including interpreter startup, heaviest imports of main: '
+          + ', '.join(f'{name} {us / 1000:.1f} ms' for us, name in main_children[:5]))
+
+    first_frames = []
+    for _ in range(repeat):
+        result = subprocess.run([sys.executable, '-c', first_frame_snippet], cwd=cwd, capture_output=True, text=True)
+        first_frames.append(float(result.stdout.strip().splitlines()[-1]))
+    print(f'  time to first frame (after interpreter start): {min(first_frames) * 1000:.1f} ms')
+    return {'import_main_ms': total_us / 1000, 'first_frame_ms': min(first_frames) * 1000,
+            'heaviest_imports_ms': {name: us / 1000 for us, name in main_children[:5]}}
+
+
+if __name__ == '__main__':
+    import argparse
+
+    parser = argparse.ArgumentParser()
+    parser.add_argument('--width', type=int, default=4000, help='synthetic input width (default 12 MP)')
+    parser.add_argument('--height', type=int, default=3000, help='synthetic input height')
+    parser.add_argument('--ticks', type=int, default=200, help='update_canvas calls to time')
+    parser.add_argument('--days', type=int, default=2, help='simulated days of the display loop')
+    parser.add_argument('--step', type=int, default=20, help='simulated minutes between renders')
+    parser.add_argument('--json', type=str, help='also write the results here, to track regressions')
+    args = parser.parse_args()
+
+    results = {
+        'startup': bench_startup(),
+        'update_canvas': bench_update_canvas(args.ticks),
+        'simulated_days': bench_simulated_days(args.days, args.step),
+        'quantize': bench_quantize(),
+        'prepare_background': bench_prepare_background(),
+        'brightness': bench_brightness((args.width, args.height)),
+        'pipeline': bench_pipeline((args.width, args.height)),
+    }
+    if args.json:
+        import json
+
+        with open(args.json, 'w') as f:
+            json.dump(results, f, indent=2)
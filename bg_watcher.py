@@ -0,0 +1,41 @@
+#!/usr/bin/env python3
+
+import os
+from pathlib import Path
+
+from prepare_cache import active_path
+
+
+class BackgroundWatcher():
+    # Tells the display loop when the active background pointer was switched. Uses inotify
+    # (inotify_simple) when it is installed, otherwise compares the link target and mtime,
+    # which is one lstat/readlink per tick.
+
+    def __init__(self, pointer=active_path):
+        self.pointer = Path(pointer)
+        self.inotify = None
+        try:
+            from inotify_simple import INotify, flags
+
+            self.inotify = INotify()
+            self.inotify.add_watch(str(self.pointer.parent), flags.CREATE | flags.MOVED_TO | flags.DELETE)
+        except (ImportError, OSError):
+            self.inotify = None
+        self.signature = self.current_signature()
+
+    def current_signature(self):
+        try:
+            return os.readlink(self.pointer), os.lstat(self.pointer).st_mtime_ns
+        except OSError:
+            return None
+
+    def changed(self):
+        if self.inotify is not None:
+            events = self.inotify.read(timeout=0)
+            if not any(event.name == self.pointer.name for event in events):
+                return False
+        signature = self.current_signature()
+        if signature == self.signature:
+            return False
+        self.signature = signature
+        return True
@@ -0,0 +1,159 @@
+#!/usr/bin/env python3
+
+import json
+import os
+import socket
+import socketserver
+import threading
+from io import BytesIO
+from datetime import datetime
+from pathlib import Path
+from time import perf_counter, time
+
+import metrics
+
+cwd_root = Path(__file__).parent.absolute()
+
+socket_path = cwd_root / 'papierek.sock'
+
+# Protocol: the client sends one JSON object per line, {"cmd": ...}. The daemon answers with
+# one JSON line, {"ok": true, ...}; for "frame" the line carries "length" and that many bytes
+# of PNG follow.
+
+
+class ControlError(OSError):
+    # the daemon answered with an error, or hung up before it answered; callers treat it like a
+    # daemon that isn't there
+    pass
+
+
+class ControlServer():
+    # Owns the running Papierek: the display loop and socket clients both render and show
+    # through here, one at a time.
+
+    def __init__(self, papierek, watcher=None):
+        self.papierek = papierek
+        self.watcher = watcher
+        self.lock = threading.RLock()
+        self.stats = {'started': time(), 'renders': 0, 'last_render_s': None, 'last_show_s': None,
+                      'forced_renders': 0, 'backgrounds_pushed': 0}
+        self.server = None
+        self.pending_tick = None  # the boundary the scheduler last rendered ahead for
+
+    def render(self, time_now=None):
+        # the scheduler passes the coming boundary; a forced render in the lead window before it
+        # must not put the minute that is about to end back on the canvas
+        with self.lock:
+            if time_now:
+                self.pending_tick = time_now
+            else:
+                time_now = datetime.now()
+                if self.pending_tick and self.pending_tick > time_now:
+                    time_now = self.pending_tick
+            if self.watcher and self.watcher.changed():
+                self.reload_bg()
+            start = perf_counter()
+            with metrics.timed('update_canvas'):
+                self.papierek.update_canvas(time_now)
+            self.stats['last_render_s'] = perf_counter() - start
+            self.stats['renders'] += 1
+
+    def show(self):
+        with self.lock:
+            start = perf_counter()
+            self.papierek.show()
+            self.stats['last_show_s'] = perf_counter() - start
+
+    def reload_bg(self):
+        # a background picked in the web uploader is already prepared, just load it
+        from prepare_cache import active_path, load_prepared
+
+        if active_path.exists():
+            self.papierek.set_bg(*load_prepared(active_path))
+        else:
+            self.papierek.set_bg(None, True)
+
+    def force_render(self):
+        # the e-ink refresh takes a while, don't keep the client waiting for it
+        def work():
+            self.render()
+            self.show()
+
+        threading.Thread(target=work, daemon=True).start()
+
+    def handle(self, message):
+        cmd = message.get('cmd')
+        if cmd == 'set_bg':
+            from prepare_cache import activate
+
+            with self.lock:
+                activate(message['key'])
+                if self.watcher:
+                    self.watcher.changed()  # already dealt with here
+                self.reload_bg()
+                self.stats['backgrounds_pushed'] += 1
+            self.force_render()
+            return {'ok': True}, None
+        if cmd == 'render':
+            with self.lock:
+                self.stats['forced_renders'] += 1
+            self.force_render()
+            return {'ok': True}, None
+        if cmd == 'frame':
+            with self.lock:
+                frame = self.papierek.canvas.copy()
+            png = BytesIO()
+            frame.save(png, 'PNG')
+            return {'ok': True, 'length': png.tell()}, png.getvalue()
+        if cmd == 'metrics':
+            return {'ok': True, 'metrics': metrics.snapshot()}, None
+        if cmd == 'stats':
+            with self.lock:
+                stats = dict(self.stats, refreshes=self.papierek.refreshes,
+                             refreshes_avoided=self.papierek.refreshes_avoided)
+            return {'ok': True, 'stats': stats}, None
+        return {'ok': False, 'error': f'unknown command {cmd}'}, None
+
+    def serve(self, path=socket_path):
+        control = self
+
+        class Handler(socketserver.StreamRequestHandler):
+            def handle(self):
+                for line in self.rfile:
+                    try:
+                        reply, payload = control.handle(json.loads(line))
+                    except Exception as e:
+                        reply, payload = {'ok': False, 'error': str(e)}, None
+                    self.wfile.write(json.dumps(reply).encode() + b'\n')
+                    if payload:
+                        self.wfile.write(payload)
+                    self.wfile.flush()
+
+        if os.path.exists(path):
+            os.unlink(path)  # left over from a previous run
+        self.server = socketserver.ThreadingUnixStreamServer(str(path), Handler)
+        self.server.daemon_threads = True
+        threading.Thread(target=self.server.serve_forever, daemon=True).start()
+
+
+def request(cmd, path=socket_path, timeout=10, **kwargs):
+    # one round trip to the daemon, returns (reply, payload bytes or None)
+    with socket.socket(socket.AF_UNIX, socket.SOCK_STREAM) as sock:
+        sock.settimeout(timeout)
+        sock.connect(str(path))
+        stream = sock.makefile('rwb')
+        stream.write(json.dumps(dict(kwargs, cmd=cmd)).encode() + b'\n')
+        stream.flush()
+        line = stream.readline()
+        if not line:
+            raise ControlError(f'{cmd}: the daemon closed the connection')
+        try:
+            reply = json.loads(line)
+        except ValueError as e:
+            raise ControlError(f'{cmd}: bad reply, {e}')
+        payload = stream.read(reply['length']) if 'length' in reply else None
+        if payload is not None and len(payload) != reply['length']:
+            raise ControlError(f'{cmd}: reply cut short')
+    if not reply.get('ok'):
+        raise ControlError(f'{cmd}: {reply.get("error")}')
+    return reply, payload
@@ -0,0 +1,258 @@
+#!/usr/bin/env python3
+
+import hashlib
+import threading
+from collections import OrderedDict
+from datetime import datetime
+from http.server import BaseHTTPRequestHandler, ThreadingHTTPServer
+from sys import stderr
+from time import time
+from urllib.error import HTTPError, URLError
+from urllib.parse import parse_qs, urlencode, urlparse
+from urllib.request import Request, urlopen
+
+import numpy as np
+from PIL import Image
+
+import frame
+import main
+import metrics
+
+# Protocol: GET /frame?at=<unix time>[&lat=..&lon=..][&bg=<prepared key>][&theme=dark] answers with
+# the packed frame for the minute `at` falls in (frame.frame_bytes of application/octet-stream) and
+# its ETag. A client sending If-None-Match with the frame it already shows gets a 304. Without
+# lat/lon the server's own location is used; bg is a key from the prepared cache and brings its own
+# theme, theme only matters without one: dark keeps the dark theme all day, by default the theme
+# follows the day as Papierek's does.
+
+
+class Renderer(main.Papierek):
+    # renders for the displays, never drives a panel itself
+    @staticmethod
+    def try_real_hw():
+        return None
+
+
+# stands in for a background while the text of a background override is rendered. Papierek draws
+# text in white or black only, so whatever isn't red afterwards is text, in the colour it was drawn
+placeholder_colour = 2
+
+
+def frame_etag(packed):
+    return hashlib.blake2b(packed, digest_size=8).hexdigest()
+
+
+class FrameServer():
+    # Renders once per location and theme a minute, however many displays ask. Weather is
+    # shared through main.weather, so OWM calls follow the locations too.
+    max_backgrounds = 32
+    max_frames = 256
+
+    def __init__(self, location):
+        self.location = location  # for the clients that don't say where they are
+        self.lock = threading.Lock()
+        self.renderers = {}  # (location key, bright, on a background) -> Renderer
+        self.overlays = {}  # (location key, bright, on a background) -> (minute, indices, text mask)
+        self.backgrounds = OrderedDict()  # prepared key -> (indices, bright)
+        self.frames = OrderedDict()  # (location key, bright, bg key) -> (minute, packed, etag)
+
+    def overlay(self, coords, bright, minute, on_bg=False):
+        # the frame for a theme, or for any background of that brightness: the text drawn over a
+        # placeholder and where it is, the theme switching exactly as it would over a real one
+        key = (main.weather.key(coords), bright, on_bg)
+        cached = self.overlays.get(key)
+        if cached and cached[0] == minute:
+            return cached[1:]
+        renderer = self.renderers.get(key)
+        if renderer is None:
+            renderer = self.renderers[key] = Renderer(coords=coords)
+            if on_bg:
+                placeholder = Image.new('P', renderer.size, placeholder_colour)
+                placeholder.putpalette(frame.palette)
+                renderer.set_bg(placeholder, bright)
+            else:
+                renderer.keep_theme = not bright
+                renderer.set_bg(None, bright)
+        with metrics.timed('fanout_render'):
+            renderer.update_canvas(datetime.fromtimestamp(minute * 60))
+        indices = np.asarray(renderer.canvas)
+        self.overlays[key] = (minute, indices, indices != placeholder_colour if on_bg else None)
+        return self.overlays[key][1:]
+
+    def background(self, bg_key):
+        from prepare_cache import cached_path, load_prepared
+
+        if bg_key in self.backgrounds:
+            self.backgrounds.move_to_end(bg_key)
+        else:
+            prepared, bright = load_prepared(cached_path(bg_key))
+            self.backgrounds[bg_key] = (np.asarray(prepared), bright)
+            if len(self.backgrounds) > self.max_backgrounds:
+                self.backgrounds.popitem(last=False)
+        return self.backgrounds[bg_key]
+
+    def frame(self, coords, minute, bg_key=None, bright=True):
+        # (packed frame, etag) for one display
+        with self.lock:
+            if bg_key:
+                bg, bright = self.background(bg_key)
+            key = (main.weather.key(coords), bright, bg_key)
+            cached = self.frames.get(key)
+            if cached and cached[0] == minute:
+                metrics.inc('fanout_frame_hits')
+                self.frames.move_to_end(key)
+                return cached[1:]
+
+            indices, mask = self.overlay(coords, bright, minute, bool(bg_key))
+            if bg_key:
+                # the text goes on the background exactly as Papierek would draw it there
+                indices = np.where(mask, indices, bg)
+            packed = frame.pack(indices)
+            self.frames[key] = (minute, packed, frame_etag(packed))
+            self.frames.move_to_end(key)
+            if len(self.frames) > self.max_frames:
+                self.frames.popitem(last=False)
+            metrics.inc('fanout_frame_renders')
+            return self.frames[key][1:]
+
+    def serve(self, host='0.0.0.0', port=8642):
+        server = self
+
+        class Handler(BaseHTTPRequestHandler):
+            def do_GET(self):
+                url = urlparse(self.path)
+                if url.path == '/metrics':
+                    return self.reply(200, metrics.render_prometheus({'fanout': metrics.snapshot()}).encode(),
+                                      'text/plain; version=0.0.4')
+                if url.path != '/frame':
+                    return self.reply(404, b'not found\n')
+                query = {name: values[-1] for name, values in parse_qs(url.query).items()}
+                try:
+                    if 'lat' in query and 'lon' in query:
+                        coords = (float(query['lat']), float(query['lon']))
+                    else:
+                        coords = server.location.get()
+                    minute = int(float(query.get('at', time())) // 60)
+                    bg_key = query.get('bg')
+                    if bg_key and (len(bg_key) != 64 or set(bg_key) - set('0123456789abcdef')):
+                        raise ValueError(f'bad background key {bg_key}')
+                except ValueError as e:
+                    return self.reply(400, f'{e}\n'.encode())
+                if not coords:
+                    return self.reply(503, b'location not known yet\n')
+                try:
+                    packed, etag = server.frame(coords, minute, bg_key, query.get('theme') != 'dark')
+                except FileNotFoundError:
+                    return self.reply(404, b'unknown background\n')
+                if self.headers.get('If-None-Match') == etag:
+                    metrics.inc('fanout_not_modified')
+                    return self.reply(304, b'', headers={'ETag': etag})
+                self.reply(200, packed, 'application/octet-stream', {'ETag': etag})
+
+            def reply(self, status, body, content_type='text/plain', headers=None):
+                self.send_response(status)
+                for name, value in (headers or {}).items():
+                    self.send_header(name, value)
+                if status != 304:
+                    self.send_header('Content-Type', content_type)
+                    self.send_header('Content-Length', str(len(body)))
+                self.end_headers()
+                self.wfile.write(body)
+
+            def log_message(self, format, *args):
+                pass  # a request per display a minute, the metrics have the numbers
+
+        httpd = ThreadingHTTPServer((host, port), Handler)
+        httpd.daemon_threads = True
+        threading.Thread(target=httpd.serve_forever, daemon=True).start()
+        return httpd
+
+
+class FrameClient():
+    # all a display does in fan-out mode: fetch the packed frame ahead of the minute, push it at the minute
+
+    def __init__(self, url, display, coords=None, bg_key=None, dark=False, timeout=10):
+        self.url = url.rstrip('/') + '/frame'
+        self.display = display
+        self.params = {}
+        if coords:
+            self.params.update(lat=coords[0], lon=coords[1])
+        if bg_key:
+            self.params['bg'] = bg_key
+        if dark:
+            self.params['theme'] = 'dark'
+        self.timeout = timeout
+        self.etag = None  # of the frame on the panel
+        self.pending = None  # (packed, etag) fetched for the coming minute
+
+    def fetch(self, time_now):
+        query = urlencode(dict(self.params, at=int(time_now.timestamp())))
+        request = Request(f'{self.url}?{query}', headers={'If-None-Match': self.etag} if self.etag else {})
+        try:
+            with urlopen(request, timeout=self.timeout) as response:
+                self.pending = response.read(), response.headers['ETag']
+        except HTTPError as e:
+            if e.code != 304:
+                print(f'frame server answered {e.code}', file=stderr)
+            self.pending = None
+        except URLError as e:
+            # keep showing what is there
+            print(f'frame server unreachable: {e.reason}', file=stderr)
+            self.pending = None
+
+    def apply(self):
+        if self.pending is None:
+            return False
+        packed, etag = self.pending
+        self.pending = None
+        if etag == self.etag:
+            return False
+        if self.display:
+            frame.to_inky(self.display, packed)
+            self.display.show(busy_wait=True)
+        else:
+            print(f'frame {etag} (no panel)', file=stderr)
+        self.etag = etag
+        return True
+
+
+if __name__ == '__main__':
+    import argparse
+
+    parser = argparse.ArgumentParser()
+    parser.add_argument('--connect', '-c', type=str, required=False,
+                        help='run as a display client of the frame server at this URL')
+    parser.add_argument('--apikey', '-a', type=str, required=False, help='OpenWeatherMap API key (server)')
+    parser.add_argument('--host', type=str, default='0.0.0.0', help='address to serve frames on (server)')
+    parser.add_argument('--port', type=int, default=8642, help='port to serve frames on (server)')
+    parser.add_argument('--lat', type=float, required=False, help='latitude, instead of looking it up by IP')
+    parser.add_argument('--lon', type=float, required=False, help='longitude, instead of looking it up by IP')
+    parser.add_argument('--bg', type=str, required=False, help='prepared background key to show (client)')
+    parser.add_argument('--dark', action='store_true', help='dark theme without a background (client)')
+    parser.add_argument('--refresh', '-r', type=int, default=2, help='refresh the display every N minutes (client)')
+    args = parser.parse_args()
+    coords = (args.lat, args.lon) if args.lat is not None and args.lon is not None else None
+
+    from scheduler import TickScheduler
+
+    if args.connect:
+        client = FrameClient(args.connect, main.Papierek.try_real_hw(), coords, args.bg, args.dark)
+        client.fetch(datetime.now())
+        client.apply()
+        TickScheduler(refresh_every=args.refresh).run(client.fetch, client.apply)
+
+    if not args.apikey:
+        parser.error('the server needs --apikey')
+
+    import pyowm
+
+    from location import Location
+    from weather_provider import WeatherProvider
+
+    main.owm = pyowm.OWM(API_key=args.apikey, language='pl')
+    main.weather = WeatherProvider(main.owm)
+
+    server = FrameServer(Location(override=coords))
+    server.serve(args.host, args.port)
+    print(f'serving frames on {args.host}:{args.port}', file=stderr)
+    threading.Event().wait()
@@ -0,0 +1,43 @@
+#!/usr/bin/env python3
+
+import numpy as np
+from PIL import Image
+
+# A frame is the 400x300 panel in palette indices (white, black, red), four pixels to a byte,
+# first pixel in the top bits: 30000 bytes against 120000 for the 'P' image.
+size = (400, 300)
+frame_bytes = size[0] * size[1] // 4
+palette = (255, 255, 255, 0, 0, 0, 255, 0, 0) + (0, 0, 0) * 252
+
+
+def pack(img):
+    # a 'P' image, or an array of palette indices such as the Inky driver's buf
+    values = np.asarray(img, dtype=np.uint8).reshape(-1, 4)
+    if values.max() > 3:
+        raise ValueError(f'palette index {values.max()} does not fit in 2 bits')
+    packed = values[:, 0] << 6 | values[:, 1] << 4 | values[:, 2] << 2 | values[:, 3]
+    return packed.tobytes()
+
+
+def indices(buf):
+    # palette index per pixel, rows of the panel: the layout the Inky driver keeps in its buf
+    packed = np.frombuffer(buf, dtype=np.uint8, count=frame_bytes)
+    unpacked = np.empty((frame_bytes, 4), dtype=np.uint8)
+    for i, shift in enumerate((6, 4, 2, 0)):
+        unpacked[:, i] = packed >> shift & 3
+    return unpacked.reshape(size[1], size[0])
+
+
+def unpack(buf):
+    img = Image.fromarray(indices(buf), 'P')
+    img.putpalette(palette)
+    return img
+
+
+def to_inky(display, buf):
+    # straight into the driver's buffer when it has the panel's shape, skipping the PIL image
+    driver_buf = getattr(display, 'buf', None)
+    if driver_buf is not None and driver_buf.shape == (size[1], size[0]):
+        driver_buf[:] = indices(buf)
+    else:
+        display.set_image(unpack(buf))
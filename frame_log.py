@@ -0,0 +1,108 @@
+#!/usr/bin/env python3
+
+import mmap
+import os
+import struct
+from pathlib import Path
+from time import time
+
+import frame
+
+cwd_root = Path(__file__).parent.absolute()
+
+log_path = cwd_root / 'frame_log.bin'
+
+# Layout: a header (magic, slots, frame size, epoch, frames appended so far) and a ring of slots, each
+# the frame's sequence number, when it went to the panel, the packed frame and the sequence
+# number again. The writer zeroes the leading number before touching a slot and bumps the count
+# last, so a reader in another process can tell a slot that is being overwritten from a whole one.
+# The epoch is random and new whenever the log is started over, sequence numbers count from 1
+# again then, so (epoch, seq) is what names a frame for good.
+header = struct.Struct('<4sIIQQ')
+magic = b'CIF2'
+record_head = struct.Struct('<Qd')
+record_tail = struct.Struct('<Q')
+
+
+class FrameLog():
+
+    def __init__(self, buf, slots, epoch):
+        self.buf = buf
+        self.slots = slots
+        self.epoch = epoch
+        self.record_bytes = record_head.size + frame.frame_bytes + record_tail.size
+
+    @classmethod
+    def create(cls, path=log_path, slots=128):
+        # for the display daemon; a log of the same shape is appended to, anything else is started over
+        path = Path(path)
+        size = header.size + slots * (record_head.size + frame.frame_bytes + record_tail.size)
+        fd = os.open(path, os.O_RDWR | os.O_CREAT, 0o644)
+        try:
+            existing = os.read(fd, header.size)
+            if len(existing) < header.size or header.unpack(existing)[:3] != (magic, slots, frame.frame_bytes) \
+                    or os.fstat(fd).st_size != size:
+                os.ftruncate(fd, 0)
+                os.ftruncate(fd, size)
+                epoch = int.from_bytes(os.urandom(8), 'little')
+                os.pwrite(fd, header.pack(magic, slots, frame.frame_bytes, epoch, 0), 0)
+            buf = mmap.mmap(fd, size)
+            return cls(buf, slots, header.unpack_from(buf)[3])
+        finally:
+            os.close(fd)
+
+    @classmethod
+    def open(cls, path=log_path):
+        # read only, for the web side. None while no daemon has written a log
+        try:
+            with open(path, 'rb') as f:
+                buf = mmap.mmap(f.fileno(), 0, access=mmap.ACCESS_READ)
+        except (OSError, ValueError):
+            return None
+        if len(buf) < header.size:
+            return None
+        found, slots, frame_bytes, epoch, _ = header.unpack_from(buf)
+        if found != magic or frame_bytes != frame.frame_bytes:
+            return None
+        return cls(buf, slots, epoch)
+
+    def count(self):
+        return header.unpack_from(self.buf)[4]
+
+    def offset(self, seq):
+        return header.size + (seq - 1) % self.slots * self.record_bytes
+
+    def append(self, packed, when=None):
+        seq = self.count() + 1
+        offset = self.offset(seq)
+        record_head.pack_into(self.buf, offset, 0, 0.0)
+        start = offset + record_head.size
+        self.buf[start:start + frame.frame_bytes] = packed
+        record_tail.pack_into(self.buf, start + frame.frame_bytes, seq)
+        record_head.pack_into(self.buf, offset, seq, time() if when is None else when)
+        header.pack_into(self.buf, 0, magic, self.slots, frame.frame_bytes, self.epoch, seq)
+        return seq
+
+    def get(self, seq):
+        # (seq, when, packed frame), or None once the ring has moved past it
+        if seq < 1 or seq > self.count() or seq <= self.count() - self.slots:
+            return None
+        offset = self.offset(seq)
+        head_seq, when = record_head.unpack_from(self.buf, offset)
+        start = offset + record_head.size
+        packed = self.buf[start:start + frame.frame_bytes]
+        tail_seq, = record_tail.unpack_from(self.buf, start + frame.frame_bytes)
+        head_again, _ = record_head.unpack_from(self.buf, offset)
+        if not head_seq == tail_seq == head_again == seq:
+            return None  # overwritten while we were reading
+        return seq, when, packed
+
+    def latest(self):
+        return self.get(self.count())
+
+    def history(self, limit=None):
+        # newest first
+        count = self.count()
+        oldest = max(count - min(limit or self.slots, self.slots), 0)
+        records = (self.get(seq) for seq in range(count, oldest, -1))
+        return [record for record in records if record]
@@ -0,0 +1,246 @@
+#!/usr/bin/env python3
+
+from bisect import bisect_right
+from enum import Enum
+from functools import lru_cache
+from math import ceil
+from pathlib import Path
+
+from PIL import ImageFont
+
+import metrics
+
+cwd_root = Path(__file__).parent.absolute()
+
+# Every sentence on the display comes from a small, finite set: hour and minute counts, the
+# humidity buckets, the OWM descriptions. Each phrase is built and fitted to the panel once,
+# after that a tick only looks them up.
+
+width = 400
+margin = 15
+gap = 10  # between two runs sharing a row
+smallest = 10  # font size the fitting gives up at
+
+# upper bound (exclusive) of the relative humidity -> what it feels like
+humidity_buckets = ((20, 'całkiem suche powietrze'), (30, 'coś tam wilgoć'), (40, 'nawet wilgoć'),
+                    (55, 'idealnie wilogotno'), (65, 'dosyć wilgotno'), (75, 'bardziej wilgotno'),
+                    (85, 'wilgotno wilgotno'), (92, 'nie wilogtno, a mokro'), (None, 'bardzo wilgotne powietrze'))
+
+# detailed_status as OWM sends it with language='pl'
+known_statuses = ('bezchmurnie', 'pochmurno', 'zachmurzenie małe', 'zachmurzenie umiarkowane', 'zachmurzenie duże',
+                  'słabe opady deszczu', 'umiarkowane opady deszczu', 'intensywne opady deszczu',
+                  'bardzo intensywne opady deszczu', 'ulewa', 'marznący deszcz', 'przelotne opady deszczu',
+                  'lekka mżawka', 'mżawka', 'intensywna mżawka', 'słabe opady śniegu', 'śnieg', 'intensywne opady śniegu',
+                  'deszcz ze śniegiem', 'przelotne opady śniegu', 'burza', 'burza z lekkimi opadami deszczu',
+                  'burza z opadami deszczu', 'burza z intensywnymi opadami deszczu', 'mgła', 'zamglenia', 'dym',
+                  'pył', 'piasek', 'popiół wulkaniczny', 'szkwał', 'tornado')
+
+
+class Align(Enum):
+    CENTER = 0
+    LEFT = 1
+    RIGHT = 2
+
+
+center = (width // 2, 150)
+# (font size, bold, anchor, align) of each part of the weather block
+sunrise_slot = (17, True, (margin, 281), Align.LEFT)
+sunset_slot = (17, True, (width - margin, 281), Align.RIGHT)
+status_slot = (18, True, center, Align.CENTER)
+temperature_slot = (29, False, (center[0], 180), Align.CENTER)
+humidity_slot = (19, False, (center[0], center[1] + 65), Align.CENTER)
+error_slot = (19, True, center, Align.CENTER)
+
+
+@lru_cache(maxsize=None)
+def load_font(face, size):
+    # every face/size pair is parsed once per process
+    with metrics.timed('font_load'):
+        return ImageFont.truetype(str(cwd_root / 'fonts' / face), size)
+
+
+def font_face(bold):
+    return 'Lato-Bold.ttf' if bold else 'Lato-Regular.ttf'
+
+
+def text_size(font, text):
+    # the advance or the ink, whichever reaches further; hinting makes a 1-bit rendering
+    # wider than the antialiased one at some sizes
+    right, bottom = font.getbbox(text)[2:]
+    return max(ceil(font.getlength(text)), right, font.getbbox(text, mode='1')[2]), bottom
+
+
+@lru_cache(maxsize=8192)
+def measure(text, size, bold):
+    return text_size(load_font(font_face(bold), size), text)[0]
+
+
+def plural_ending(num):
+    # godzin/minut + ę, y or nothing
+    if num <= 20 and num >= 10:
+        return ''
+    elif num % 10 == 1:
+        return 'ę'
+    elif num % 10 in (2, 3, 4):
+        return 'y'
+    else:
+        return ''
+
+
+def count(num, unit):
+    return f'{str(num) + " " if num > 1 else ""}{unit}{plural_ending(num)}'
+
+
+@lru_cache(maxsize=None)
+def sunrise_phrase(hour, minute):
+    return f'Słońce wzejdzie o {hour}:{minute:02}'
+
+
+@lru_cache(maxsize=None)
+def day_length_phrase(hours):
+    return f'dzień potrwa {count(hours, "godzin")}'
+
+
+@lru_cache(maxsize=None)
+def until_sunset_phrase(num, unit):
+    return f'Słońce zajdzie za {count(num, unit)}'
+
+
+@lru_cache(maxsize=None)
+def since_sunset_phrase(num, unit):
+    return f'Słońce zaszło {count(num, unit)} temu'
+
+
+@lru_cache(maxsize=None)
+def status_phrase(detailed_status):
+    # the first word goes last, and some of them get a bit friendlier
+    words = detailed_status.split(' ')
+    words.append(words.pop(0))
+    phrase = ' '.join(words)
+    phrase = phrase.replace('zachmurzenie', 'zachmurkowanie')
+    return phrase.replace('pochmurno', 'pochmurko')
+
+
+@lru_cache(maxsize=1024)
+def temperature_phrase(temperature, stale=False):
+    phrase = str(round(float(temperature), 1)).replace('.', ',') + '°C'
+    if stale:
+        # refresh failed, this is the last good reading
+        phrase += '*'
+    return phrase
+
+
+@lru_cache(maxsize=None)
+def humidity_phrase(rel_humidity):
+    bounds = [bound for bound, _ in humidity_buckets[:-1]]
+    return f'{humidity_buckets[bisect_right(bounds, rel_humidity)][1]} ({str(rel_humidity)}%)'
+
+
+def room(anchor, align):
+    # widest a run can get at this anchor without leaving the panel margins
+    x = anchor[0]
+    if align == Align.LEFT:
+        return width - margin - x
+    if align == Align.RIGHT:
+        return x - margin
+    return 2 * min(x - margin, width - margin - x)
+
+
+@lru_cache(maxsize=4096)
+def fit(text, size, bold, anchor, align, max_width=None):
+    # the run, in a smaller font if it would not fit otherwise
+    max_width = min(max_width or width, room(anchor, align))
+    while size > smallest and measure(text, size, bold) > max_width:
+        size -= 1
+    return text, size, bold, anchor, align
+
+
+def run(text, slot, max_width=None):
+    # (text, size, bold, anchor, align) ready for Papierek.draw_run
+    return fit(text, *slot, max_width)
+
+
+@lru_cache(maxsize=4096)
+def shared_row(left_text, left_slot, right_text, right_slot):
+    # two runs on one row: left as they are if they fit side by side, otherwise half of the row each
+    text_width = measure(left_text, *left_slot[:2]) + measure(right_text, *right_slot[:2])
+    half_row = (width - 2 * margin - gap) // 2
+    max_width = None if text_width + gap <= width - 2 * margin else half_row
+    return run(left_text, left_slot, max_width), run(right_text, right_slot, max_width)
+
+
+def text_width(run):
+    text, size, bold, anchor, align = run
+    return measure(text, size, bold)
+
+
+def overflows(runs):
+    # runs sharing a row: each within the margins and all of them side by side
+    if any(text_width(run) > room(run[3], run[4]) for run in runs):
+        return True
+    return sum(text_width(run) for run in runs) + gap * (len(runs) - 1) > width - 2 * margin
+
+
+def phrase_space():
+    # (text, slot, max width) of everything with a handful of variants
+    for hours in range(25):
+        yield until_sunset_phrase(hours, 'godzin'), sunset_slot, None
+        yield since_sunset_phrase(hours, 'godzin'), sunset_slot, None
+    for minutes in range(61):
+        yield until_sunset_phrase(minutes, 'minut'), sunset_slot, None
+        yield since_sunset_phrase(minutes, 'minut'), sunset_slot, None
+    for rel_humidity in range(101):
+        yield humidity_phrase(rel_humidity), humidity_slot, None
+    for detailed_status in known_statuses:
+        yield status_phrase(detailed_status), status_slot, None
+
+
+def check_space():
+    # every row weather_runs can draw, fitted, with the font sizes they started from. on top of
+    # the above: each sunrise time with each day length, and every temperature a thermometer in Poland shows
+    for text, slot, max_width in phrase_space():
+        yield (run(text, slot, max_width),), (slot[0],)
+    for hour in range(24):
+        for minute in range(60):
+            for hours in range(25):
+                yield shared_row(sunrise_phrase(hour, minute), sunrise_slot, day_length_phrase(hours), sunset_slot), \
+                      (sunrise_slot[0], sunset_slot[0])
+    for tenths in range(-500, 501):
+        for stale in (False, True):
+            yield (run(temperature_phrase(tenths / 10, stale), temperature_slot),), (temperature_slot[0],)
+    yield (run('dane pogodowe z internetu błąd', error_slot),), (error_slot[0],)
+
+
+def check():
+    # (rows checked, {(font size, fitted size, text)} of the shrunk ones, [runs] still overflowing)
+    checked, shrunk, overflowing = 0, set(), []
+    for runs, sizes in check_space():
+        checked += 1
+        if overflows(runs):
+            overflowing.append(runs)
+        shrunk.update((size, run[1], run[0]) for run, size in zip(runs, sizes) if run[1] != size)
+    return checked, shrunk, overflowing
+
+
+def precompute():
+    # sunrise times and temperatures are fitted as they come, one a day or so
+    with metrics.timed('layout_precompute'):
+        for text, slot, max_width in phrase_space():
+            run(text, slot, max_width)
+
+
+if __name__ == '__main__':
+    import argparse
+
+    parser = argparse.ArgumentParser()
+    parser.add_argument('--check', action='store_true', help='fit every phrase and list the ones that still overflow')
+    args = parser.parse_args()
+
+    if args.check:
+        checked, shrunk, overflowing = check()
+        for size, fitted_size, text in sorted(shrunk, key=lambda s: s[2]):
+            print(f'shrunk {size} -> {fitted_size}: {text}')
+        for runs in overflowing:
+            print('OVERFLOW: ' + ' | '.join(f'{run[0]} at size {run[1]}' for run in runs))
+        print(f'{checked} rows, {len(shrunk)} phrases shrunk to fit, {len(overflowing)} overflowing')
+        exit(1 if overflowing else 0)
@@ -0,0 +1,75 @@
+#!/usr/bin/env python3
+
+import json
+import os
+import threading
+from pathlib import Path
+from sys import stderr
+from time import time
+
+import metrics
+
+cwd_root = Path(__file__).parent.absolute()
+
+
+class Location():
+    url = 'https://geolocation-db.com/json/'
+    # the display does not move around much
+    ttl = 7 * 24 * 60 * 60
+    timeout = 5
+    retry_after = 60
+
+    def __init__(self, override=None, cache_path=cwd_root / 'coords_cache.json'):
+        self.cache_path = cache_path
+        self.lock = threading.Lock()
+        self.looking_up = False
+        self.last_attempt = 0
+        if override:
+            self.coords, self.fetched = tuple(override), None
+        else:
+            self.coords, self.fetched = self.load()
+
+    def get(self):
+        # never waits for the network, an expired or missing location is looked up in the background
+        if self.fetched is not None and time() - self.fetched > self.ttl:
+            self.lookup_async()
+        elif self.coords is None:
+            self.lookup_async()
+        return self.coords
+
+    def lookup_async(self):
+        with self.lock:
+            if self.looking_up or time() - self.last_attempt < self.retry_after:
+                return
+            self.looking_up = True
+            self.last_attempt = time()
+        threading.Thread(target=self.lookup, daemon=True).start()
+
+    def lookup(self):
+        import requests
+
+        try:
+            metrics.inc('geolocation_api_calls')
+            response = requests.get(self.url, timeout=self.timeout)
+            data = response.json()
+            self.coords, self.fetched = (data['latitude'], data['longitude']), time()
+            self.save()
+        except (requests.RequestException, ValueError, KeyError, TypeError) as e:
+            print(f'Cannot find out where we are: {e}', file=stderr)
+        finally:
+            with self.lock:
+                self.looking_up = False
+
+    def load(self):
+        try:
+            with open(self.cache_path) as f:
+                cached = json.load(f)
+            return tuple(cached['coords']), cached['fetched']
+        except (OSError, ValueError, KeyError, TypeError):
+            return None, None
+
+    def save(self):
+        tmp_path = f'{self.cache_path}.tmp'
+        with open(tmp_path, 'w') as f:
+            json.dump({'coords': self.coords, 'fetched': self.fetched}, f)
+        os.replace(tmp_path, self.cache_path)
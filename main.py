@@ -1,44 +1,84 @@
 #!/usr/bin/env python3
 
+from time import perf_counter
+
+started = perf_counter()
+
 from datetime import datetime, timedelta
-from enum import Enum
+from functools import lru_cache
 from pathlib import Path
 
-import pyowm
-import requests
-from PIL import Image, ImageDraw, ImageFont
+from PIL import Image, ImageDraw
+
+import layout
+import metrics
+from layout import Align, load_font
+from location import Location
 
 cwd_root = Path(__file__).parent.absolute()
 
 owm = None
+weather = None  # WeatherProvider wrapping owm
 
 
 # http://api.openweathermap.org/data/2.5/weather?q=warsaw,pl&appid=06056367d0061e003264ced903bb2921
 
-class Align(Enum):
-    CENTER = 0
-    LEFT = 1
-    RIGHT = 2
+@lru_cache(maxsize=256)
+def text_mask(text, face, size):
+    # 1-bit rendering of a string, pasted with the minor colour wherever it is drawn
+    metrics.inc('text_mask_renders')
+    font = load_font(face, size)
+    mask = Image.new('1', layout.text_size(font, text))
+    ImageDraw.Draw(mask).text((0, 0), text, font=font, fill=1)
+    return mask
+
+
+class WeatherUnavailable(Exception):
+    pass
 
 
 class Papierek():
     size = (400, 300)
     center = (size[0] // 2, size[1] // 2)
 
-    def __init__(self):
+    def __init__(self, coords=None):
         self.set_bright_theme(True)
         self.canvas = Image.new('P', self.size, self.major_colour)
         self.canvas.putpalette((255, 255, 255, 0, 0, 0, 255, 0, 0) + (0, 0, 0) * 252)
-        self.canvas_draw = ImageDraw.Draw(self.canvas)
         self.bg = None
+        self.keep_theme = False  # stay in the theme set_bg picked instead of following the day
+        self.layers = {}  # cached background and weather layers, see base_layer / weather_layer
+        self.playlist = None
+        self.playlist_index = None
         self.inky_display = self.try_real_hw()
-        self.generate_fonts()
+        self.last_frame = None
+        self.frame_log = None  # FrameLog the pushed frames are appended to, for the web preview
+        self.refreshes = 0
+        self.refreshes_avoided = 0
+        self.location = Location(override=coords)
         self.coords = self.fetch_coords()
 
     def set_bg(self, bg_im, bg_bright):
         self.bg = bg_im
+        self.invalidate_layers()
         self.set_bright_theme(bg_bright)
 
+    def set_playlist(self, playlist):
+        self.playlist = playlist
+        self.playlist_index = None
+
+    def rotate_bg(self, time_now):
+        # the frames are prepared already, switching is an unpack and only when the pick changes
+        status = None
+        if self.playlist.mode == 'weather' and weather is not None and self.coords:
+            observation = weather.get(self.coords)
+            status = observation and observation.detailed_status
+        index = self.playlist.pick(time_now, status)
+        if index != self.playlist_index:
+            self.playlist_index = index
+            self.set_bg(*self.playlist.frame(index))
+            metrics.inc('playlist_switches')
+
     def set_bright_theme(self, switch=True):
         if switch:
             self.major_colour = 0
@@ -47,234 +87,182 @@ class Papierek():
             self.major_colour = 1
             self.minor_colour = 0
 
-    def calc_text_pos(self, text_str, font, align=Align.CENTER):
+    @staticmethod
+    def align_pos(text_size, align=Align.CENTER):
+        w, h = text_size
         if align == Align.CENTER:
-            w, h = font.getsize(text_str)
             pos = (-w // 2, -h // 2)
         elif align == Align.LEFT:
-            w, h = font.getsize(text_str)
             pos = (0, -h // 2)
         elif align == Align.RIGHT:
-            w, h = font.getsize(text_str)
             pos = (-w, -h // 2)
         return pos
 
-    @staticmethod
-    def fetch_coords():
-        coords = None
-        try:
-            response = requests.get("https://geolocation-db.com/json/")
-            coords = (response.json()['latitude'], response.json()['longitude'])
-        except pyowm.exceptions.api_call_error.APICallTimeoutError:
-            from sys import stderr
-            print('Cannot connect to the weather API', file=stderr)
-            coords = None
-        finally:
-            return coords
-
-    def generate_fonts(self, size=None):
-        if not size:
-            sizes = [15, 20, 60]
-            self.fonts = {}
-        else:
-            sizes = [size]
-        for size_n in sizes:
-            self.fonts.update({size_n: ImageFont.truetype(str(cwd_root / 'fonts' / 'Lato-Regular.ttf'), size_n)})
+    def fetch_coords(self):
+        # cached on disk, a missing location is looked up in the background
+        return self.location.get()
 
-    def get_font(self, size, **kwargs):
-        if 'bold' in kwargs:
-            if kwargs.get('bold') == True:
-                font = ImageFont.truetype(str(cwd_root / 'fonts' / 'Lato-Bold.ttf'), size)
-                return font
+    @staticmethod
+    def font_face(bold):
+        return layout.font_face(bold)
 
-        else:
-            try:
-                return self.fonts[size]
-            except KeyError:
-                self.generate_fonts(size)
-                return self.fonts[size]
-
-    def update_canvas(self):
-        time_now = datetime.now()
+    def update_canvas(self, time_now=None):
+        # time_now lets the frame for the coming minute be rendered ahead of time
+        time_now = time_now or datetime.now()
         time_str = time_now.strftime("%_H:%M")
 
-        self.clear_working_canvas()
-
         if not self.coords:
             self.coords = self.fetch_coords()
+        if self.playlist:
+            self.rotate_bg(time_now)
 
+        runs = ()
         try:
-            if not self.coords:
-                raise pyowm.exceptions.api_call_error.APICallTimeoutError('dane pogodowe z internetu błąd')
-            observation = owm.weather_at_coords(*self.coords)
-            last_updated = datetime.fromtimestamp(observation.get_reception_time())
-            weather = observation.get_weather()
-            weather_measuremnt = datetime.fromtimestamp(weather.get_reference_time())
-
-            # sections to blit
-            sunrise_dt = datetime.fromtimestamp(weather.get_sunrise_time())
-            sunset_dt = datetime.fromtimestamp(weather.get_sunset_time())
-
-            sunrise_str = None
-            sunset_str = None
-
-            # determine whether ew are after past 0:00
-            if time_now < sunrise_dt:
-                # before sunrise
-                if not self.bg:
-                    self.set_bright_theme(False)
-
-                sunrise_str = f'Słońce wzejdzie o {sunrise_dt.strftime("%-H:%M")}'
-                diff = (sunset_dt - sunrise_dt).seconds / 60 / 60
-                diff = int(round(diff, 0))
-                sunset_str = f'dzień potrwa {str(diff) + " " if diff > 1 else ""}godzin{self.godziny(diff)}'
-            elif time_now < sunset_dt:
-                # mid day
+            runs = self.weather_runs(time_now)
+        except WeatherUnavailable as e:
+            from sys import stderr
+            print(e, file=stderr)
+            runs = (layout.run(str(e), layout.error_slot),)
+
+        finally:
+            # only the clock is drawn every tick, the rest comes from the cached layers
+            self.canvas = self.weather_layer(runs).copy()
+            self.draw_run((time_str, 60, False, (self.center[0], self.center[1] - 52), Align.CENTER))
+
+    def weather_runs(self, time_now):
+        # text runs of the weather block: (text, font size, bold, anchor, align)
+        if weather is None:
+            # still starting up, the first frame is just the clock
+            return ()
+        if not self.coords:
+            raise WeatherUnavailable('dane pogodowe z internetu błąd')
+        observation = weather.get(self.coords)
+        if not observation:
+            # nothing cached yet, the first refresh is still on its way
+            raise WeatherUnavailable('dane pogodowe z internetu błąd')
+        last_updated = datetime.fromtimestamp(observation.reception_time)
+        weather_measuremnt = datetime.fromtimestamp(observation.reference_time)
+
+        # sections to blit
+        sunrise_dt = datetime.fromtimestamp(observation.sunrise_time)
+        sunset_dt = datetime.fromtimestamp(observation.sunset_time)
+
+        # every phrase comes fitted to the panel from layout, built once and looked up after that
+        runs = []
+        if time_now < sunrise_dt:
+            # before sunrise
+            if not self.bg and not self.keep_theme:
+                self.set_bright_theme(False)
+
+            hours = int(round((sunset_dt - sunrise_dt).seconds / 60 / 60, 0))
+            runs += layout.shared_row(layout.sunrise_phrase(sunrise_dt.hour, sunrise_dt.minute), layout.sunrise_slot,
+                                      layout.day_length_phrase(hours), layout.sunset_slot)
+        elif time_now < sunset_dt:
+            # mid day
+            if not self.keep_theme:
                 self.set_bright_theme(True)
 
-                if sunset_dt - time_now > timedelta(hours=1):
-                    diff = (sunset_dt - time_now).seconds / 60 / 60
-                    diff = round(diff, 0)
-                    sunset_str = f'Słońce zajdzie za {str(diff) + " " if diff > 1 else ""}godzin{self.godziny(diff)}'
-                else:
-                    diff = (sunset_dt - time_now).seconds / 60
-                    diff = round(diff, 0)
-                    sunset_str = f'Słońce zajdzie za {str(diff) + " " if diff > 1 else ""}minut{self.godziny(diff)}'
+            if sunset_dt - time_now > timedelta(hours=1):
+                hours = int(round((sunset_dt - time_now).seconds / 60 / 60, 0))
+                runs.append(layout.run(layout.until_sunset_phrase(hours, 'godzin'), layout.sunset_slot))
             else:
-                # evening
-                if not self.bg:
-                    self.set_bright_theme(False)
-
-                if time_now - sunset_dt > timedelta(hours=1):
-                    diff = (time_now - sunset_dt).seconds / 60 / 60
-                    diff = int(round(diff, 0))
-                    sunset_str = f'Słońce zaszło {str(diff) + " " if diff > 1 else ""}godzin{self.godziny(diff)} temu'
-                else:
-                    diff = (time_now - sunset_dt).seconds / 60
-                    diff = int(round(diff, 0))
-                    sunset_str = f'Słońce zaszło {str(diff) + " " if diff > 1 else ""}minut{self.godziny(diff)} temu'
-
-            # clear
-            self.clear_working_canvas()
-
-            if sunrise_str:
-                self.canvas_draw.text(self.tuple_add(
-                    self.calc_text_pos(sunrise_str, self.get_font(17, bold=True), Align.LEFT),
-                    (0 + 15, 181 + 100)
-                )
-                    , sunrise_str,
-                    font=self.get_font(17, bold=True),
-                    fill=self.minor_colour)
-            if sunset_str:
-                self.canvas_draw.text(self.tuple_add(
-                    self.calc_text_pos(sunset_str, self.get_font(17, bold=True), Align.RIGHT),
-                    (self.size[0] - 15, 181 + 100)
-                )
-                    , sunset_str,
-                    font=self.get_font(17, bold=True),
-                    fill=self.minor_colour)
-
-            detailed_status = weather.get_detailed_status()
-            detailed_status = detailed_status.split(' ')
-            detailed_status.append(detailed_status.pop(0))
-            detailed_status = ' '.join(detailed_status)
-            detailed_status = detailed_status.replace('zachmurzenie', 'zachmurkowanie')
-            detailed_status = detailed_status.replace('pochmurno', 'pochmurko')
-            self.canvas_draw.text(self.tuple_add(
-                self.calc_text_pos(detailed_status, self.get_font(18, bold=True)),
-                self.center
-            )
-                , detailed_status,
-                font=self.get_font(18, bold=True),
-                fill=self.minor_colour)
-
-            temperature = f'{weather.get_temperature(unit="celsius")["temp"]}'
-            temperature = str(round(float(temperature), 1))
-            temperature = temperature.replace('.', ',')
-            temperature += '°C'
-            self.canvas_draw.text(self.tuple_add(
-                self.calc_text_pos(temperature, self.get_font(29)),
-                (self.center[0], 180)
-            )
-                , temperature,
-                font=self.get_font(29),
-                fill=self.minor_colour)
-
-            rel_humidity = weather.get_humidity()
-            h_desc = None
-            if rel_humidity < 20:
-                h_desc = 'całkiem suche powietrze'
-            elif rel_humidity < 30:
-                h_desc = 'coś tam wilgoć'
-            elif rel_humidity < 40:
-                h_desc = 'nawet wilgoć'
-            elif rel_humidity < 55:
-                h_desc = 'idealnie wilogotno'
-            elif rel_humidity < 65:
-                h_desc = 'dosyć wilgotno'
-            elif rel_humidity < 75:
-                h_desc = 'bardziej wilgotno'
-            elif rel_humidity < 85:
-                h_desc = 'wilgotno wilgotno'
-            elif rel_humidity < 92:
-                h_desc = 'nie wilogtno, a mokro'
+                minutes = int(round((sunset_dt - time_now).seconds / 60, 0))
+                runs.append(layout.run(layout.until_sunset_phrase(minutes, 'minut'), layout.sunset_slot))
+        else:
+            # evening
+            if not self.bg and not self.keep_theme:
+                self.set_bright_theme(False)
+
+            if time_now - sunset_dt > timedelta(hours=1):
+                hours = int(round((time_now - sunset_dt).seconds / 60 / 60, 0))
+                runs.append(layout.run(layout.since_sunset_phrase(hours, 'godzin'), layout.sunset_slot))
+            else:
+                minutes = int(round((time_now - sunset_dt).seconds / 60, 0))
+                runs.append(layout.run(layout.since_sunset_phrase(minutes, 'minut'), layout.sunset_slot))
+
+        runs.append(layout.run(layout.status_phrase(observation.detailed_status), layout.status_slot))
+        runs.append(layout.run(layout.temperature_phrase(observation.temperature, observation.stale),
+                               layout.temperature_slot))
+        runs.append(layout.run(layout.humidity_phrase(observation.humidity), layout.humidity_slot))
+
+        # response = requests.get(observation.get_weather_icon_url())
+        # weather_icon = Image.open(BytesIO(response.content))
+        # self.canvas.paste(weather_icon, (50, 50))
+        return tuple(runs)
+
+    def draw_run(self, run, image=None):
+        text, size, bold, anchor, align = run
+        mask = text_mask(text, self.font_face(bold), size)
+        x, y = self.tuple_add(self.align_pos(mask.size, align), anchor)
+        (image or self.canvas).paste(self.minor_colour, (x, y, x + mask.size[0], y + mask.size[1]), mask)
+
+    def base_layer(self):
+        # background, or a plain fill of the theme colour
+        key = (id(self.bg), self.major_colour)
+        if self.layers.get('base_key') != key:
+            if self.bg:
+                base = self.bg.copy()
             else:
-                h_desc = 'bardzo wilgotne powietrze'
-
-            rel_humidity_str = f'{h_desc} ({str(rel_humidity)}%)'
-            self.canvas_draw.text(self.tuple_add(
-                self.calc_text_pos(rel_humidity_str, self.get_font(19)),
-                (self.center[0], self.center[1] + 65)
-            )
-                , rel_humidity_str,
-                font=self.get_font(19),
-                fill=self.minor_colour)
-
-            # response = requests.get(weather.get_weather_icon_url())
-            # weather_icon = Image.open(BytesIO(response.content))
-            # self.canvas.paste(weather_icon, (50, 50))
-        except pyowm.exceptions.api_call_error.APICallTimeoutError as e:
-            self.clear_working_canvas()
+                base = Image.new('P', self.size, self.major_colour)
+                base.putpalette(self.canvas.getpalette())
+            self.layers.update(base_key=key, base=base, weather_key=None)
+        return self.layers['base']
+
+    def weather_layer(self, runs):
+        # base with the weather block on top, redrawn only when its text or colours change
+        base = self.base_layer()
+        key = (runs, self.minor_colour)
+        if self.layers.get('weather_key') != key:
+            metrics.inc('weather_layer_redraws')
+            layer = base.copy()
+            for run in runs:
+                self.draw_run(run, layer)
+            self.layers.update(weather_key=key, weather=layer)
+        return self.layers['weather']
+
+    def invalidate_layers(self):
+        self.layers = {}
 
-            from sys import stderr
-            print(e._message, file=stderr)
-            self.canvas_draw.text(self.tuple_add(
-                self.calc_text_pos(e._message, font=self.get_font(19, bold=True)),
-                (self.center[0], self.center[1])
-            )
-                , e._message, font=self.get_font(19, bold=True),
-                fill=self.minor_colour)
-
-        except:
-            self.clear_working_canvas()
-            raise
+    def show(self):
+        import frame
 
-        finally:
-            self.canvas_draw.text(self.tuple_add(
-                self.calc_text_pos(time_str, self.fonts[60]),
-                (self.center[0], self.center[1] - 52)
-            )
-                , time_str, font=self.fonts[60],
-                fill=self.minor_colour)
-
-    def godziny(self, num):
-        if num <= 20 and num >= 10:
-            return ''
-        elif num % 10 == 1:
-            return 'ę'
-        elif num % 10 in (2, 3, 4):
-            return 'y'
-        else:
-            return ''
+        packed = frame.pack(self.canvas)
+        if packed == self.last_frame:
+            # a full refresh of the red panel takes ~15 s, don't do it for nothing
+            self.refreshes_avoided += 1
+            metrics.inc('refreshes_avoided')
+            from sys import stderr
+            print(f'frame unchanged, {self.refreshes_avoided} refreshes avoided so far', file=stderr)
+            return False
 
-    def show(self):
         if self.inky_display:
             self.inky_display.set_image(self.canvas)  # .rotate(180))
-            self.inky_display.show(busy_wait=True)
+            # the stock InkyWHAT driver always refreshes the whole panel,
+            # drivers which can do a band of rows expose set_partial_mode
+            set_partial_mode = getattr(self.inky_display, 'set_partial_mode', None)
+            if set_partial_mode:
+                set_partial_mode(*self.dirty_band(packed))
+            with metrics.timed('show'):
+                self.inky_display.show(busy_wait=True)
         else:
             self.canvas.putpalette((190, 190, 190, 25, 25, 25, 150, 20, 60) + (0, 0, 0) * 252)
             self.canvas.show(title=__class__.__name__)
 
+        if self.frame_log:
+            self.frame_log.append(packed)
+        self.last_frame = packed  # kept 2 bits a pixel, see frame.py
+        self.refreshes += 1
+        metrics.inc('refreshes')
+        return True
+
+    def dirty_band(self, packed):
+        # first and last (exclusive) row that differ from the last pushed frame
+        if self.last_frame is None:
+            return 0, self.size[1]
+        w = self.size[0] // 4
+        changed = [y for y in range(self.size[1]) if packed[y * w:(y + 1) * w] != self.last_frame[y * w:(y + 1) * w]]
+        return changed[0], changed[-1] + 1
+
     @staticmethod
     def try_real_hw():
         try:
@@ -292,13 +280,6 @@ class Papierek():
             ret.append(tup1[i] + tup2[i])
         return tuple(ret)
 
-    def clear_working_canvas(self):
-        if self.bg:
-            self.canvas = self.bg.copy()
-            self.canvas_draw = ImageDraw.Draw(self.canvas)
-        else:
-            self.canvas_draw.rectangle((0, 0, *self.size), self.major_colour)
-
 
 if __name__ == '__main__':
     import argparse
@@ -307,44 +288,94 @@ if __name__ == '__main__':
     parser.add_argument('--image', '-i', type=str, required=False, help="Input image to be displayed as background")
     parser.add_argument('--apikey', '-a', type=str, required=True, help='OpenWeatherMap API key')
     parser.add_argument('--oneshot', '-1', type=bool, required=False, help='to loop or not')
+    parser.add_argument('--refresh', '-r', type=int, default=2, help='refresh the display every N minutes')
+    parser.add_argument('--socket', '-s', type=str, default=str(cwd_root / 'papierek.sock'),
+                        help='unix socket to take commands on, empty to disable')
+    parser.add_argument('--lat', type=float, required=False, help='latitude, instead of looking it up by IP')
+    parser.add_argument('--lon', type=float, required=False, help='longitude, instead of looking it up by IP')
+    parser.add_argument('--frame-log', type=str, default=str(cwd_root / 'frame_log.bin'),
+                        help='ring log of the frames pushed to the panel, empty to disable')
+    parser.add_argument('--playlist', '-p', type=str, required=False,
+                        help='directory of backgrounds or a playlist JSON to rotate through')
+    parser.add_argument('--rotate', choices=('round-robin', 'time-of-day', 'weather'), required=False,
+                        help='how the playlist picks a background (default round-robin)')
+    parser.add_argument('--rotate-every', type=int, required=False,
+                        help='minutes between playlist turns (default 10)')
     args = parser.parse_args()
 
-    owm_apikey = args.apikey
-    owm = pyowm.OWM(API_key=owm_apikey, language='pl')
+    papierek = Papierek(coords=(args.lat, args.lon) if args.lat is not None and args.lon is not None else None)
+    if args.frame_log:
+        from frame_log import FrameLog
 
-    papierek = Papierek()
+        papierek.frame_log = FrameLog.create(args.frame_log)
 
-    if args.image:
-        # oh, there is a image.
-        # threshold it and then:
-        # - if it is dark, then make it even darker
-        # - if it is bright, make it brighter
-        bg = Image.open(cwd_root / args.image)
+    # first pixels before any of the network, weather or image processing modules are even imported
+    if not args.oneshot:
+        papierek.update_canvas()
+        from sys import stderr
+        print(f'first frame after {perf_counter() - started:.2f} s', file=stderr)
+        papierek.show()
 
-        from prepare_brightness import threshold, get_modified
+    import pyowm
 
-        if_brighter = threshold(bg)
-        bg_1_stage = get_modified(bg, if_brighter)
+    owm_apikey = args.apikey
+    owm = pyowm.OWM(API_key=owm_apikey, language='pl')
 
-        # transform to eink colourspace
-        import prepare_colourspace
+    from weather_provider import WeatherProvider
+
+    weather = WeatherProvider(owm)
+    # every phrase with a handful of variants gets fitted now, the ticks only look them up
+    layout.precompute()
+
+    if args.playlist:
+        # every entry is prepared once and kept packed in a memory-mapped file
+        from playlist import Playlist, load_entries
+
+        entries, spec = load_entries(args.playlist)
+        papierek.set_playlist(Playlist(entries, args.rotate or spec.get('mode', 'round-robin'),
+                                       args.rotate_every or spec.get('every', 10)).build())
+    elif args.image:
+        # oh, there is a image. downscale it, pick a theme by its brightness and transform to eink colourspace,
+        # or just pick it up from the cache if it has been prepared before
+        from prepare_cache import cached_prepare
+
+        bg, if_brighter, _ = cached_prepare(cwd_root / args.image)
+        papierek.set_bg(bg, if_brighter)
+    else:
+        # whatever was last picked in the web uploader, already prepared
+        from prepare_cache import active_path, load_prepared
+
+        if active_path.exists():
+            papierek.set_bg(*load_prepared(active_path))
+
+    if args.oneshot:
+        # a single frame has no later tick to pick up a background lookup or refresh
+        if not papierek.coords:
+            papierek.location.lookup()
+            papierek.coords = papierek.location.coords
+        if papierek.coords:
+            weather.refresh(papierek.coords)
+    else:
+        # get the weather in before the next tick
+        papierek.coords = papierek.fetch_coords()
+        if papierek.coords:
+            weather.get(papierek.coords)
+
+    from scheduler import TickScheduler
+
+    scheduler = TickScheduler(refresh_every=args.refresh)
+
+    if args.oneshot:
+        papierek.update_canvas()
+        papierek.show()
+        exit(0)
 
-        bg_2_stage = prepare_colourspace.prepare(bg_1_stage)
-        papierek.set_bg(bg_2_stage, if_brighter)
+    from bg_watcher import BackgroundWatcher
+    from control import ControlServer
+    from prepare_cache import active_path
 
-    from time import sleep
+    control = ControlServer(papierek, BackgroundWatcher(active_path))
+    if args.socket:
+        control.serve(args.socket)
 
-    while True:
-        papierek.update_canvas()
-        if not datetime.now().minute%2:
-            papierek.show()
-        sleep(1)
-        target_time = datetime.now()
-        target_time = target_time.replace(minute=(target_time.minute + 1) % 59, second=0)
-        to_sleep = target_time - datetime.now()
-        if args.oneshot:
-            exit(0)
-        sleep(to_sleep.seconds)
-        # wait until full minute
-        while datetime.now().second != 0:
-            pass
+    scheduler.run(control.render, control.show)
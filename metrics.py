@@ -0,0 +1,91 @@
+#!/usr/bin/env python3
+
+import threading
+from contextlib import contextmanager
+from time import perf_counter
+
+# upper bounds in seconds, from a glyph paste to a full e-ink refresh
+buckets = (0.001, 0.005, 0.01, 0.025, 0.05, 0.1, 0.25, 0.5, 1, 2.5, 5, 10, 30)
+
+lock = threading.Lock()
+histograms = {}  # stage -> {'buckets': [count per bucket, +Inf last], 'sum': seconds, 'count': n}
+counters = {}  # name -> value
+
+
+def observe(stage, seconds):
+    with lock:
+        histogram = histograms.setdefault(stage, {'buckets': [0] * (len(buckets) + 1), 'sum': 0.0, 'count': 0})
+        index = next((i for i, bound in enumerate(buckets) if seconds <= bound), len(buckets))
+        histogram['buckets'][index] += 1
+        histogram['sum'] += seconds
+        histogram['count'] += 1
+
+
+def inc(name, value=1):
+    with lock:
+        counters[name] = counters.get(name, 0) + value
+
+
+@contextmanager
+def timed(stage):
+    start = perf_counter()
+    try:
+        yield
+    finally:
+        observe(stage, perf_counter() - start)
+
+
+def snapshot():
+    with lock:
+        return {'histograms': {stage: {'buckets': list(h['buckets']), 'sum': h['sum'], 'count': h['count']}
+                               for stage, h in histograms.items()},
+                'counters': dict(counters)}
+
+
+def drain():
+    # snapshot and start over, for handing a worker process' numbers to its parent
+    with lock:
+        taken = {'histograms': dict(histograms), 'counters': dict(counters)}
+        histograms.clear()
+        counters.clear()
+    return taken
+
+
+def merge(taken):
+    with lock:
+        for stage, h in taken['histograms'].items():
+            mine = histograms.setdefault(stage, {'buckets': [0] * (len(buckets) + 1), 'sum': 0.0, 'count': 0})
+            mine['buckets'] = [a + b for a, b in zip(mine['buckets'], h['buckets'])]
+            mine['sum'] += h['sum']
+            mine['count'] += h['count']
+        for name, value in taken['counters'].items():
+            counters[name] = counters.get(name, 0) + value
+
+
+def render_prometheus(snapshots, prefix='cloudink'):
+    # Prometheus text exposition of {process name: snapshot()}, one family per metric name
+    lines = []
+
+    stages = [(process, stage, h) for process, taken in snapshots.items() for stage, h in taken['histograms'].items()]
+    if stages:
+        family = f'{prefix}_stage_seconds'
+        lines.append(f'# HELP {family} Time spent per stage.')
+        lines.append(f'# TYPE {family} histogram')
+        for process, stage, h in sorted(stages, key=lambda s: s[:2]):
+            labels = f'process="{process}",stage="{stage}"'
+            cumulative = 0
+            for bound, count in zip(buckets + ('+Inf',), h['buckets']):
+                cumulative += count
+                lines.append(f'{family}_bucket{{{labels},le="{bound}"}} {cumulative}')
+            lines.append(f'{family}_sum{{{labels}}} {h["sum"]}')
+            lines.append(f'{family}_count{{{labels}}} {h["count"]}')
+
+    names = sorted({name for taken in snapshots.values() for name in taken['counters']})
+    for name in names:
+        family = f'{prefix}_{name}_total'
+        lines.append(f'# TYPE {family} counter')
+        for process, taken in sorted(snapshots.items()):
+            if name in taken['counters']:
+                lines.append(f'{family}{{process="{process}"}} {taken["counters"][name]}')
+
+    return '\n'.join(lines) + '\n'
@@ -0,0 +1,106 @@
+#!/usr/bin/env python3
+
+import json
+import mmap
+import os
+from pathlib import Path
+
+import frame
+
+cwd_root = Path(__file__).parent.absolute()
+
+modes = ('round-robin', 'time-of-day', 'weather')
+store_path = cwd_root / 'playlist_frames.bin'
+
+# Store layout: one record per entry, a byte with the brightness decision followed by the
+# packed frame. The keys the records were built from sit next to it in a .json file.
+record_bytes = 1 + frame.frame_bytes
+
+
+def load_entries(path):
+    # a directory of images, or a JSON file: {"mode": ..., "every": minutes, "entries": [
+    #   {"image": "rain.jpg", "weather": ["deszcz", "mżawka"]}, {"image": "dawn.jpg", "hours": [5, 9]}, ...]}
+    # image paths in the JSON are relative to the file
+    path = Path(path)
+    if path.is_dir():
+        from prepare_batch import find_inputs
+
+        return [{'image': str(src)} for src in find_inputs([str(path)])], {}
+    with open(path) as f:
+        spec = json.load(f)
+    entries = [dict(entry, image=str(path.parent / entry['image'])) for entry in spec['entries']]
+    return entries, {name: spec[name] for name in ('mode', 'every') if name in spec}
+
+
+class Playlist():
+
+    def __init__(self, entries, mode='round-robin', every=10, path=store_path):
+        if mode not in modes:
+            raise ValueError(f'unknown playlist mode {mode}')
+        if not entries:
+            raise ValueError('empty playlist')
+        self.entries = entries
+        self.mode = mode
+        self.every = every
+        self.path = Path(path)
+        self.frames = None
+
+    def build(self):
+        # prepare every entry once, later runs reuse the store as long as the images are the same
+        from prepare_cache import cache_key, cached_prepare
+
+        keys = [cache_key(Path(entry['image']).read_bytes()) for entry in self.entries]
+        index_path = self.path.with_suffix('.json')
+        try:
+            with open(index_path) as f:
+                up_to_date = json.load(f) == keys
+        except (OSError, ValueError):
+            up_to_date = False
+
+        if not up_to_date or not self.path.exists():
+            tmp_path = self.path.with_suffix(f'.{os.getpid()}.tmp')
+            with open(tmp_path, 'wb') as f:
+                for entry in self.entries:
+                    prepared, bright, _ = cached_prepare(entry['image'])
+                    f.write(bytes((bright,)) + frame.pack(prepared))
+            os.replace(tmp_path, self.path)
+            with open(index_path, 'w') as f:
+                json.dump(keys, f)
+
+        with open(self.path, 'rb') as f:
+            self.frames = mmap.mmap(f.fileno(), 0, access=mmap.ACCESS_READ)
+        return self
+
+    def frame(self, index):
+        # (image, bright) of one entry, unpacked from the store when it is needed
+        offset = index * record_bytes
+        record = self.frames[offset:offset + record_bytes]
+        return frame.unpack(record[1:]), record[0] == 1
+
+    def pick(self, time_now, status=None):
+        # index of the entry to show at time_now; status is the detailed weather description
+        slot = int(time_now.timestamp()) // 60 // self.every
+        candidates = list(range(len(self.entries)))
+
+        if self.mode == 'time-of-day':
+            hour = time_now.hour + time_now.minute / 60
+            timed = [i for i in candidates if 'hours' in self.entries[i]]
+            if not timed:
+                # no hours given, the day is split evenly between the entries in order
+                return int(hour * len(candidates) / 24)
+            candidates = [i for i in timed if self.within(hour, *self.entries[i]['hours'])] or \
+                         [i for i in candidates if 'hours' not in self.entries[i]] or candidates
+        elif self.mode == 'weather':
+            status = (status or '').lower()
+            tagged = [i for i in candidates if 'weather' in self.entries[i]]
+            candidates = [i for i in tagged if any(word.lower() in status for word in self.entries[i]['weather'])] or \
+                         [i for i in candidates if 'weather' not in self.entries[i]] or candidates
+
+        # the ones that fit take turns
+        return candidates[slot % len(candidates)]
+
+    @staticmethod
+    def within(hour, start, end):
+        if start <= end:
+            return start <= hour < end
+        return hour >= start or hour < end  # across midnight
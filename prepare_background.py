@@ -0,0 +1,57 @@
+#!/usr/bin/env python3
+
+from PIL import Image, ImageChops, ImageFilter, ImageStat
+
+import metrics
+import prepare_colourspace
+from prepare_brightness import threshold, get_modified, percv_brightness
+
+# mean per-channel difference (0..1) of the blurred outputs that still counts as the same picture
+visual_tolerance = 0.05
+
+
+def draft_size(size):
+    # smallest decode size that still covers the display height after fit()
+    w, h = size
+    scale = prepare_colourspace.size[1] / h
+    return int(w * scale) + 1, int(h * scale) + 1
+
+
+def prepare_background(src):
+    # downscale first, then threshold it and:
+    # - if it is dark, then make it even darker
+    # - if it is bright, make it brighter
+    # all the brightness work happens on the 400x300 working image
+    bg = Image.open(src)
+    bg.draft('RGB', draft_size(bg.size))
+
+    with metrics.timed('fit'):
+        working = prepare_colourspace.fit(bg.convert('RGB'))
+
+    print(f'input brightness: {percv_brightness(working)}')
+    if_brighter = threshold(working)
+    with metrics.timed('get_modified'):
+        working = get_modified(working, if_brighter)
+
+    # transform to eink colourspace
+    with metrics.timed('quantize'):
+        return prepare_colourspace.quantize(working), if_brighter
+
+
+def visual_difference(im_a, im_b):
+    # compare the way it looks from a step away: blur away the dither pattern first
+    blurred = [im.convert('RGB').filter(ImageFilter.BoxBlur(3)) for im in (im_a, im_b)]
+    diff = ImageChops.difference(*blurred)
+    return sum(ImageStat.Stat(diff).mean) / 3 / 255
+
+
+if __name__ == '__main__':
+    import argparse
+
+    parser = argparse.ArgumentParser()
+    parser.add_argument('--image', '-i', type=str, required=True, help="Input image to be converted/displayed")
+    args = parser.parse_args()
+
+    prepared, make_bright = prepare_background(args.image)
+    print(f'went {"brighter" if make_bright else "darker"}')
+    prepared.show()
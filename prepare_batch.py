@@ -0,0 +1,139 @@
+#!/usr/bin/env python3
+
+import glob
+import io
+import os
+from concurrent.futures import ProcessPoolExecutor, as_completed
+from contextlib import redirect_stdout
+from pathlib import Path
+from time import perf_counter
+
+from PIL import Image
+
+import metrics
+from prepare_background import prepare_background
+from prepare_cache import cache_key, save_prepared
+
+image_suffixes = ('.jpg', '.jpeg', '.png', '.gif', '.bmp', '.tif', '.tiff', '.webp')
+
+
+def pattern_root(pattern):
+    # the directory a glob starts matching in, or the one a plain file name is in
+    parts = Path(pattern).parts
+    literal = []
+    for part in parts:
+        if glob.has_magic(part):
+            break
+        literal.append(part)
+    if len(literal) == len(parts):
+        literal.pop()
+    return Path(*literal) if literal else Path('.')
+
+
+def walk(pattern):
+    # (image, the directory it was found under) for one input argument
+    if os.path.isdir(pattern):
+        return [(path, Path(pattern)) for path in sorted(Path(pattern).rglob('*'))
+                if path.suffix.lower() in image_suffixes]
+    root = pattern_root(pattern)
+    return [(Path(path), root) for path in sorted(glob.glob(pattern, recursive=True)) if os.path.isfile(path)]
+
+
+def find_inputs(patterns):
+    # directories are walked for images, anything else is a file name or a glob
+    return list(dict.fromkeys(path for pattern in patterns for path, _ in walk(pattern)))
+
+
+def output_path(src, root, out_dir):
+    # the source's place under its input root, suffix kept: a/x.jpg, b/x.jpg and x.png all get their own
+    relative = Path(src).relative_to(root)
+    return Path(out_dir) / relative.parent / f'{relative.name}.png'
+
+
+def plan(patterns, out_dir):
+    # [(source, output)] for every input, refusing to run when two of them would write the same file
+    outputs = {}
+    for pattern in patterns:
+        for src, root in walk(pattern):
+            outputs.setdefault(src, output_path(src, root, out_dir))
+    sources = {}
+    for src, path in outputs.items():
+        sources.setdefault(path.resolve(), []).append(src)
+    clashes = [f'{", ".join(map(str, srcs))} -> {path}' for path, srcs in sources.items() if len(srcs) > 1]
+    if clashes:
+        raise ValueError('inputs that would overwrite each other: ' + '; '.join(clashes))
+    return list(outputs.items())
+
+
+def up_to_date(path, key):
+    # the output was made from these very bytes with the current targets and palette
+    try:
+        with Image.open(path) as prepared:
+            return prepared.info.get('key') == key
+    except (OSError, SyntaxError):
+        return False
+
+
+def prepare_file(src, path, force=False):
+    # runs in a worker, returns what the parent prints for this file
+    start = perf_counter()
+    src_bytes = Path(src).read_bytes()
+    key = cache_key(src_bytes)
+    if not force and up_to_date(path, key):
+        return {'src': str(src), 'skipped': True, 'seconds': perf_counter() - start}
+
+    log = io.StringIO()
+    with redirect_stdout(log):
+        prepared, if_brighter = prepare_background(io.BytesIO(src_bytes))
+    save_prepared(prepared, if_brighter, path, key)
+    taken = metrics.drain()
+    return {'src': str(src), 'skipped': False, 'out': str(path), 'brighter': if_brighter,
+            'seconds': perf_counter() - start, 'log': log.getvalue().splitlines(),
+            'stages': {stage: h['sum'] for stage, h in taken['histograms'].items()}}
+
+
+def prepare_batch(jobs, workers=None, force=False):
+    # (source, output) pairs from plan, yields results as the workers finish them
+    with ProcessPoolExecutor(max_workers=workers) as executor:
+        futures = {executor.submit(prepare_file, src, path, force): src for src, path in jobs}
+        for future in as_completed(futures):
+            try:
+                yield future.result()
+            except Exception as e:
+                yield {'src': str(futures[future]), 'error': str(e)}
+
+
+if __name__ == '__main__':
+    import argparse
+
+    parser = argparse.ArgumentParser()
+    parser.add_argument('inputs', nargs='+', help='image files, directories or globs (quote them)')
+    parser.add_argument('--out', '-o', type=str, required=True, help='directory for the prepared PNGs')
+    parser.add_argument('--workers', '-j', type=int, default=os.cpu_count(), help='worker processes')
+    parser.add_argument('--force', '-f', action='store_true', help='prepare even when the output is up to date')
+    args = parser.parse_args()
+
+    try:
+        jobs = plan(args.inputs, args.out)
+    except ValueError as e:
+        parser.error(str(e))
+    print(f'{len(jobs)} images, {args.workers} workers')
+    start = perf_counter()
+    done, skipped, failed = 0, 0, 0
+    for result in prepare_batch(jobs, args.workers, args.force):
+        if 'error' in result:
+            failed += 1
+            print(f'{result["src"]}: FAILED, {result["error"]}')
+        elif result['skipped']:
+            skipped += 1
+            print(f'{result["src"]}: up to date')
+        else:
+            done += 1
+            stages = ', '.join(f'{stage} {seconds * 1000:.0f} ms' for stage, seconds in result['stages'].items())
+            print(f'{result["src"]}: went {"brighter" if result["brighter"] else "darker"}, '
+                  f'{result["seconds"]:.2f}s ({stages}) -> {result["out"]}')
+            for line in result['log']:
+                print(f'  {line}')
+    print(f'{done} prepared, {skipped} up to date, {failed} failed in {perf_counter() - start:.1f}s')
+    if failed:
+        exit(1)
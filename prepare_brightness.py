@@ -36,26 +36,73 @@ def make_darker(im):
     return get_modified(im, False)
 
 
+def channel_histograms(im):
+    im = im.convert('RGB')
+    hist = im.histogram()
+    n = im.size[0] * im.size[1]
+    return [hist[0:256], hist[256:512], hist[512:768]], n
+
+
+def predicted_brightness(hists, n, factor):
+    # perceived brightness after ImageEnhance.Brightness(factor), clipping at 255 included.
+    # PIL truncates the blended value, which costs half a level on average.
+    means = []
+    for hist in hists:
+        total = 0
+        for v, count in enumerate(hist[1:], 1):
+            total += count * (255 if v * factor >= 255 else v * factor - 0.5)
+        means.append(total / n)
+    r, g, b = means
+    return math.sqrt(0.241 * (r ** 2) + 0.691 * (g ** 2) + 0.068 * (b ** 2))
+
+
+def solve_factor(hists, n, target):
+    # Every channel mean is piecewise linear in factor: value v clips once factor >= 255 / v.
+    # Walk the segments in increasing factor order and solve the quadratic in the one that
+    # contains the target.
+    weights = (0.241, 0.691, 0.068)
+    unclipped = [sum(v * count for v, count in enumerate(hist)) for hist in hists]
+    truncated = [n - hist[0] for hist in hists]
+    clipped = [0, 0, 0]
+    for k in range(256, 0, -1):
+        # values >= k are clipped in [255 / k, 255 / (k - 1))
+        if k < 256:
+            for c, hist in enumerate(hists):
+                unclipped[c] -= k * hist[k]
+                truncated[c] -= hist[k]
+                clipped[c] += hist[k]
+        lo = 255 / k if k < 256 else 0.0
+        hi = 255 / (k - 1) if k > 1 else math.inf
+
+        slopes = [unclipped[c] / n for c in range(3)]
+        offsets = [(255 * clipped[c] - 0.5 * truncated[c]) / n for c in range(3)]
+        a = sum(w * s ** 2 for w, s in zip(weights, slopes))
+        b = 2 * sum(w * s * o for w, s, o in zip(weights, slopes, offsets))
+        c = sum(w * o ** 2 for w, o in zip(weights, offsets)) - target ** 2
+
+        if a == 0:
+            if c >= 0:
+                return lo
+            continue
+        factor = (-b + math.sqrt(max(b ** 2 - 4 * a * c, 0.0))) / (2 * a)
+        if factor < hi:
+            return max(factor, lo)
+
+    # target unreachable, everything that is not black is already white
+    return 255 / next((v for v in range(1, 256) if any(hist[v] for hist in hists)), 255)
+
+
 def get_modified(im, make_brighter):
-    bg_enhancer = ImageEnhance.Brightness(im)
+    hists, n = channel_histograms(im)
 
-    new_brightness = percv_brightness(im)
     if make_brighter:
-        factor = 1.0
-        while new_brightness <= target_brighter:
-            bg_enhanced = bg_enhancer.enhance(factor)
-            new_brightness = percv_brightness(bg_enhanced)
-            # print(f'factor: {factor}, curr: {new_brightness}')
-            factor = factor * 1.05
+        factor = max(solve_factor(hists, n, target_brighter), 1.0)
     else:
-        factor = 1.0
-        while new_brightness >= target_darker:
-            bg_enhanced = bg_enhancer.enhance(factor)
-            new_brightness = percv_brightness(bg_enhanced)
-            # print(f'factor: {factor}, curr: {new_brightness}')
-            factor = factor / 1.05
-
-    print(f'acheived brighness: {new_brightness}')
+        factor = min(solve_factor(hists, n, target_darker), 1.0)
+
+    bg_enhanced = ImageEnhance.Brightness(im).enhance(factor)
+
+    print(f'factor: {factor:.3f}, acheived brighness: {predicted_brightness(hists, n, factor)}')
 
     return bg_enhanced
 
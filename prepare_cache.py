@@ -0,0 +1,122 @@
+#!/usr/bin/env python3
+
+import hashlib
+import os
+from io import BytesIO
+from pathlib import Path
+
+from PIL import Image
+from PIL.PngImagePlugin import PngInfo
+
+import metrics
+import prepare_brightness
+import prepare_colourspace
+from prepare_background import prepare_background
+
+cwd_root = Path(__file__).parent.absolute()
+
+# bumped whenever preparing a background changes in a way the parameters below don't show
+key_version = 2
+
+cache_dir = cwd_root / 'static' / 'uploads' / 'prepared'
+max_bytes = 64 * 1024 * 1024
+# symlink to the prepared frame the display should use
+active_path = cwd_root / 'bg_active.png'
+
+
+def cache_key(src_bytes):
+    # everything that changes the prepared frame goes into the key
+    params = (key_version, prepare_brightness.target_brighter, prepare_brightness.target_darker,
+              prepare_colourspace.palette, prepare_colourspace.size, prepare_colourspace.default_dither,
+              prepare_colourspace.lut_bits, prepare_colourspace.lab_scale)
+    digest = hashlib.sha256(src_bytes)
+    digest.update(repr(params).encode())
+    return digest.hexdigest()
+
+
+def cached_path(key, directory=None):
+    return Path(directory or cache_dir) / f'{key}.png'
+
+
+def load_prepared(path):
+    # lazy, only the PNG header is read here
+    prepared = Image.open(path)
+    return prepared, prepared.info.get('bright') == '1'
+
+
+def cached_prepare(src, directory=None, limit=None):
+    # returns (prepared image, whether it went brighter, cache key)
+    directory = Path(directory or cache_dir)
+    src_bytes = Path(src).read_bytes()
+    key = cache_key(src_bytes)
+    path = cached_path(key, directory)
+
+    try:
+        prepared, if_brighter = load_prepared(path)
+        os.utime(path)  # mark as recently used
+        metrics.inc('prepared_cache_hits')
+        return prepared, if_brighter, key
+    except FileNotFoundError:
+        metrics.inc('prepared_cache_misses')
+
+    prepared, if_brighter = prepare_background(BytesIO(src_bytes))
+    save_prepared(prepared, if_brighter, path, key)
+
+    evict(directory, limit or max_bytes)
+    return prepared, if_brighter, key
+
+
+def save_prepared(prepared, if_brighter, path, key):
+    # the brightness decision and the key it was made for travel inside the PNG
+    info = PngInfo()
+    info.add_text('bright', '1' if if_brighter else '0')
+    info.add_text('key', key)
+    path = Path(path)
+    path.parent.mkdir(parents=True, exist_ok=True)
+    tmp_path = path.with_suffix(f'.{os.getpid()}.tmp')
+    with metrics.timed('png_save'):
+        prepared.save(tmp_path, 'PNG', pnginfo=info)
+    os.replace(tmp_path, path)
+
+
+def activate(key, directory=None, pointer=None):
+    # switch the active background by swapping the symlink in one rename, nothing is copied
+    pointer = Path(pointer or active_path)
+    target = cached_path(key, directory)
+    if not target.exists():
+        raise FileNotFoundError(target)
+    tmp_path = pointer.with_name(f'.{pointer.name}.{os.getpid()}.tmp')
+    os.symlink(target, tmp_path)
+    os.replace(tmp_path, pointer)
+
+
+def active_target(pointer=None):
+    try:
+        return Path(os.readlink(pointer or active_path))
+    except OSError:
+        return None
+
+
+def evict(directory, limit):
+    # least recently used first, until the cache fits in limit bytes. the active background stays.
+    active = active_target()
+    entries = []
+    for path in Path(directory).glob('*.png'):
+        if path == active:
+            continue
+        try:
+            stat = path.stat()
+        except FileNotFoundError:
+            continue
+        entries.append((stat.st_mtime, stat.st_size, path))
+    entries.sort()
+
+    total = sum(size for _, size, _ in entries)
+    for _, size, path in entries:
+        if total <= limit:
+            break
+        try:
+            path.unlink()
+        except FileNotFoundError:
+            pass
+        total -= size
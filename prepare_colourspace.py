@@ -1,21 +1,75 @@
 #!/usr/bin/env python3
 
 
+import hashlib
+import os
+from functools import lru_cache
+from pathlib import Path
+
+import numpy as np
 from PIL import Image
 
 
-# Set up the inky wHAT display and border colour
+cwd_root = Path(__file__).parent.absolute()
+
+
+def load_gpl(path):
+    # colours of a GIMP palette file, in order
+    colours = []
+    with open(path) as f:
+        for line in f:
+            fields = line.split()
+            if not fields or line.startswith('#') or not fields[0].isdigit():
+                continue  # header, name, columns and comments
+            colours.append(tuple(int(v) for v in fields[:3]))
+    return tuple(colours)
+
+
+def to_palette(colours):
+    return tuple(v for colour in colours for v in colour) + (0, 0, 0) * (256 - len(colours))
+
+
+palette_file = cwd_root / 'inky-palette.gpl'
+colours = load_gpl(palette_file)  # white, black, red
+palette = to_palette(colours)
+size = (400, 300)
+
+# RGB -> palette index tables, 5 bits per channel by default; 8 bits is a 16 MB memory-mapped file
+lut_bits = 5
+lut_dir = cwd_root / 'lut_cache'
+
+# L*a*b* packed into bytes, one scale for all three axes so distances keep their proportions
+lab_scale = 1.15
+lab_offset = (0, 128, 128)
+
+# error diffusion kernels in NumPy, nearest colour by L*a*b* through the LUT: (row offset, column offset, weight).
+# plain 'floyd-steinberg' runs PIL's diffusion, in C, over the L*a*b* bytes instead; these are
+# an order of magnitude slower and there for the biases and the other kernels
+kernels = {
+    'floyd-steinberg-lab': ((0, 1, 7 / 16), (1, -1, 3 / 16), (1, 0, 5 / 16), (1, 1, 1 / 16)),
+    # Atkinson only passes on 6/8 of the error, which keeps flat areas clean
+    'atkinson': ((0, 1, 1 / 8), (0, 2, 1 / 8), (1, -1, 1 / 8), (1, 0, 1 / 8), (1, 1, 1 / 8), (2, 0, 1 / 8)),
+}
+dithers = ('floyd-steinberg', 'floyd-steinberg-lab', 'atkinson', 'bayer', 'none')
+default_dither = 'floyd-steinberg'
 
-def prepare(img) -> Image:
+bayer_matrix = np.array([[0, 8, 2, 10],
+                         [12, 4, 14, 6],
+                         [3, 11, 1, 9],
+                         [15, 7, 13, 5]]) / 16 - 0.5 + 1 / 32
+bayer_spread = 96
+
+
+def fit(img) -> Image:
     # Get the width and height of the image
 
     w, h = img.size
 
     # Calculate the new height and width of the image
 
-    h_new = 300
+    h_new = size[1]
     w_new = int((float(w) / h) * h_new)
-    w_cropped = 400
+    w_cropped = size[0]
 
     # Resize the image with high-quality resampling
 
@@ -30,31 +84,171 @@ def prepare(img) -> Image:
 
     # Crop image
 
-    img = img.crop((x0, y0, x1, y1))
+    return img.crop((x0, y0, x1, y1))
+
+
+def to_lab(rgb):
+    # sRGB (0..255, any leading shape) to CIE L*a*b*, D65
+    c = np.asarray(rgb, dtype=np.float32) / 255
+    c = np.where(c > 0.04045, ((c + 0.055) / 1.055) ** 2.4, c / 12.92)
+    xyz = c @ np.array([[0.4124 / 0.9505, 0.2126, 0.0193 / 1.089],
+                        [0.3576 / 0.9505, 0.7152, 0.1192 / 1.089],
+                        [0.1805 / 0.9505, 0.0722, 0.9505 / 1.089]], dtype=np.float32)
+    f = np.where(xyz > 0.008856, np.cbrt(xyz), 7.787 * xyz + 16 / 116)
+    return np.stack((116 * f[..., 1] - 16, 500 * (f[..., 0] - f[..., 1]), 200 * (f[..., 1] - f[..., 2])), axis=-1)
+
+
+def nearest_lab(rgb, colours, red_bias=0.0, black_bias=0.0):
+    # index of the perceptually closest colour. The biases (in delta E) make the black and the
+    # red entry win more often, which reads better on the panel than a faithful grey.
+    pal_lab = to_lab(np.array(colours, dtype=np.float32))
+    bias = np.zeros(len(colours), dtype=np.float32)
+    bias[pal_lab[:, 0].argmin()] += black_bias
+    chroma = np.hypot(pal_lab[:, 1], pal_lab[:, 2])
+    if chroma.max() > 20:
+        bias[chroma.argmax()] += red_bias
+    lab = to_lab(rgb)
+    distances = np.sqrt(((lab[..., np.newaxis, :] - pal_lab) ** 2).sum(axis=-1)) - bias
+    return distances.argmin(axis=-1).astype(np.uint8)
+
+
+@lru_cache(maxsize=8)
+def build_lut(colours=colours, bits=lut_bits, red_bias=0.0, black_bias=0.0):
+    # flat table indexed by (r << 2 * bits) | (g << bits) | b of the top bits of every channel
+    if bits == 8:
+        return mapped_lut(colours, red_bias, black_bias)
+    levels = (np.arange(1 << bits) + 0.5) * (256 >> bits)
+    grid = np.stack(np.meshgrid(levels, levels, levels, indexing='ij'), axis=-1).reshape(-1, 3)
+    return nearest_lab(grid, colours, red_bias, black_bias)
+
 
-    # Convert the image to use a white / black / red colour palette
+def mapped_lut(colours, red_bias, black_bias):
+    # the full 16M entry table is built once, a plane of red at a time, and then only mapped
+    key = hashlib.sha256(repr((colours, red_bias, black_bias)).encode()).hexdigest()[:16]
+    path = lut_dir / f'{key}.npy'
+    if not path.exists():
+        lut_dir.mkdir(parents=True, exist_ok=True)
+        tmp_path = path.with_suffix(f'.{os.getpid()}.tmp')
+        table = np.lib.format.open_memmap(tmp_path, mode='w+', dtype=np.uint8, shape=(1 << 24,))
+        g, b = np.meshgrid(np.arange(256), np.arange(256), indexing='ij')
+        for r in range(256):
+            plane = np.stack((np.full_like(g, r), g, b), axis=-1).reshape(-1, 3)
+            table[r << 16:(r + 1) << 16] = nearest_lab(plane, colours, red_bias, black_bias)
+        table.flush()
+        del table
+        os.replace(tmp_path, path)
+    return np.load(path, mmap_mode='r')
 
-    pal_img = Image.new("P", (1, 1))
-    red_pal = (255, 0, 0)
-    black_pal = (0, 0, 0)
-    white_pal = (255, 255, 255)
-    pal_img.putpalette((255, 255, 255, 0, 0, 0, 255, 0, 0) + (0, 0, 0) * 252)
-    img = img.convert("RGB").quantize(palette=pal_img)
 
+@lru_cache(maxsize=8)
+def lab_lut(bits=lut_bits):
+    # RGB -> L*a*b* bytes, same cells as build_lut
+    levels = (np.arange(1 << bits) + 0.5) * (256 >> bits)
+    grid = np.stack(np.meshgrid(levels, levels, levels, indexing='ij'), axis=-1).reshape(-1, 3)
+    return lab_bytes(to_lab(grid))
+
+
+def lab_bytes(lab):
+    return np.clip(np.asarray(lab) * lab_scale + lab_offset, 0, 255).round().astype(np.uint8)
+
+
+def lookup(rgb, lut, bits=lut_bits):
+    q = np.clip(rgb, 0, 255).astype(np.int32) >> (8 - bits)
+    return lut[(q[..., 0] << (2 * bits)) | (q[..., 1] << bits) | q[..., 2]]
+
+
+def diffuse(rgb, kernel, pal_rgb, lut, bits):
+    # Error diffusion, vectorized along anti-diagonals: with x + 2y as the step, every pixel
+    # a kernel can push error into is visited in a later step, so a whole step is one batch.
+    h, w = rgb.shape[:2]
+    pad = 2
+    stride = w + 2 * pad
+    buf = np.zeros((h + pad, stride, 3), dtype=np.float32)
+    buf[:h, pad:pad + w] = rgb
+    buf = buf.reshape(-1, 3)
+    out = np.empty(h * w, dtype=np.uint8)
+    offsets = [(dy * stride + dx, weight) for dy, dx, weight in kernel]
+    rows = np.arange(h)
+    for step in range(w + 2 * (h - 1)):
+        ys = rows[max(0, (step - w + 2) // 2):min(h, step // 2 + 1)]
+        xs = step - 2 * ys
+        at = ys * stride + xs + pad
+        px = np.clip(buf[at], 0, 255)
+        idx = lookup(px, lut, bits)
+        out[ys * w + xs] = idx
+        err = px - pal_rgb[idx]
+        for offset, weight in offsets:
+            buf[at + offset] += err * weight
+    return out.reshape(h, w)
+
+
+def lab_dither(img, colours, bits):
+    # PIL's Floyd-Steinberg over the picture and the palette in L*a*b*, so its nearest colour by
+    # distance is the perceptual one. The palette is padded with the first colour rather than
+    # black, so ties never land on an index past the real colours.
+    lab = lookup(np.asarray(img.convert('RGB')), lab_lut(bits), bits)
+    flat = lab_bytes(to_lab(np.array(colours, dtype=np.float32))).ravel().tolist()
+    pal_img = Image.new('P', (1, 1))
+    pal_img.putpalette(flat + flat[:3] * (256 - len(colours)))
+    return Image.fromarray(lab, 'RGB').quantize(palette=pal_img, dither=Image.FLOYDSTEINBERG)
+
+
+def lut_dither(img, dither, colours, bits, red_bias, black_bias):
+    # palette indices through the L*a*b* lookup table, with one of the NumPy ditherers
+    rgb = np.asarray(img.convert("RGB"), dtype=np.float32)
+    pal_rgb = np.array(colours, dtype=np.float32)
+    lut = build_lut(colours, bits, red_bias, black_bias)
+
+    if dither in kernels:
+        return diffuse(rgb, kernels[dither], pal_rgb, lut, bits)
+    if dither == 'bayer':
+        h, w = rgb.shape[:2]
+        threshold = np.tile(bayer_matrix, (h // 4 + 1, w // 4 + 1))[:h, :w, np.newaxis]
+        return lookup(rgb + threshold * bayer_spread, lut, bits)
+    if dither == 'none':
+        return lookup(rgb, lut, bits)
+    raise ValueError(f'unknown dither {dither}, pick one of {dithers}')
+
+
+def quantize(img, dither=default_dither, colours=colours, bits=lut_bits, red_bias=0.0, black_bias=0.0) -> Image:
+    # Convert the image to use a white / black / red colour palette (or whatever colours holds)
+
+    if dither == 'floyd-steinberg' and (red_bias or black_bias):
+        # PIL has no notion of the biases, only the nearest colour table does
+        dither = 'floyd-steinberg-lab'
+
+    if dither == 'floyd-steinberg':
+        indices = np.asarray(lab_dither(img, colours, bits))
+    else:
+        indices = lut_dither(img, dither, colours, bits, red_bias, black_bias)
+
+    img = Image.fromarray(indices.astype(np.uint8), "P")
+    img.putpalette(to_palette(colours))
     return img
 
 
+def prepare(img, dither=default_dither) -> Image:
+    return quantize(fit(img), dither)
+
+
 if __name__ == '__main__':
     import argparse
 
     parser = argparse.ArgumentParser()
     parser.add_argument('--image', '-i', type=str, required=True, help="Input image to be converted/displayed")
+    parser.add_argument('--dither', '-d', choices=dithers, default=default_dither, help='dithering method')
+    parser.add_argument('--palette', '-p', type=str, default=str(palette_file), help='GIMP .gpl palette of the panel')
+    parser.add_argument('--red-bias', type=float, default=0.0, help='favour the red entry by this much delta E')
+    parser.add_argument('--black-bias', type=float, default=0.0, help='favour the black entry by this much delta E')
+    parser.add_argument('--lut-bits', type=int, choices=range(4, 9), default=lut_bits,
+                        help='bits per channel of the colour lookup table, 8 maps a 16 MB file')
     args = parser.parse_args()
 
     img_file = args.image
 
     img_in = Image.open(img_file)
-    img_out = prepare(img_in)
+    img_out = quantize(fit(img_in), args.dither, load_gpl(args.palette), args.lut_bits, args.red_bias,
+                       args.black_bias)
 
 
     def try_real_hw():
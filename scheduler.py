@@ -0,0 +1,46 @@
+#!/usr/bin/env python3
+
+import time
+from datetime import datetime
+
+
+class TickScheduler():
+    # Wakes up `lead` seconds before every `period` boundary of the wall clock to render,
+    # then sleeps until the boundary itself to show. Deadlines are kept on the monotonic
+    # clock so wall clock adjustments cannot make it spin or oversleep.
+
+    def __init__(self, period=60, lead=5, refresh_every=2, clock=time.monotonic, wall=time.time, sleep=time.sleep):
+        self.period = period
+        self.lead = lead
+        self.refresh_every = refresh_every
+        self.clock = clock
+        self.wall = wall
+        self.sleep = sleep
+
+    def next_tick(self):
+        # (wall clock time of the next boundary, the same moment on the monotonic clock)
+        wall_now = self.wall()
+        mono_now = self.clock()
+        boundary = (wall_now // self.period + 1) * self.period
+        return boundary, mono_now + (boundary - wall_now)
+
+    def sleep_until(self, deadline):
+        remaining = deadline - self.clock()
+        while remaining > 0:
+            self.sleep(remaining)
+            remaining = deadline - self.clock()
+
+    def is_refresh_tick(self, boundary):
+        return int(boundary // self.period) % self.refresh_every == 0
+
+    def tick(self, render, show):
+        boundary, deadline = self.next_tick()
+        self.sleep_until(deadline - self.lead)
+        render(datetime.fromtimestamp(boundary))
+        self.sleep_until(deadline)
+        if self.is_refresh_tick(boundary):
+            show()
+
+    def run(self, render, show):
+        while True:
+            self.tick(render, show)
@@ -0,0 +1,49 @@
+import socketserver
+import threading
+from functools import partial
+
+import pytest
+
+import control
+
+
+def stub_daemon(path, answer):
+    # answers every request line with `answer`, or hangs up when it is None
+    class Handler(socketserver.StreamRequestHandler):
+        def handle(self):
+            self.rfile.readline()
+            if answer is not None:
+                self.wfile.write(answer)
+
+    server = socketserver.ThreadingUnixStreamServer(str(path), Handler)
+    threading.Thread(target=server.serve_forever, daemon=True).start()
+    return server
+
+
+@pytest.mark.parametrize('answer', (b'{"ok": false, "error": "no such background"}\n', b'', None, b'{"ok": tr'))
+def test_failed_requests_raise_control_error(tmp_path, answer):
+    server = stub_daemon(tmp_path / 'sock', answer)
+    try:
+        with pytest.raises(control.ControlError):
+            control.request('set_bg', path=tmp_path / 'sock', timeout=2, key='0' * 64)
+    finally:
+        server.shutdown()
+        server.server_close()
+
+
+def test_background_evicted_before_the_daemon_switches_is_a_404(tmp_path, monkeypatch):
+    import web_uploader
+
+    server = stub_daemon(tmp_path / 'sock', b'{"ok": false, "error": "gone"}\n')
+    (tmp_path / 'prepared.png').touch()
+    monkeypatch.setattr(web_uploader, 'cached_path', lambda key: tmp_path / 'prepared.png')
+    monkeypatch.setattr(web_uploader.control, 'request', partial(control.request, path=tmp_path / 'sock', timeout=2))
+    monkeypatch.setattr(web_uploader, 'activate', partial(web_uploader.activate, directory=tmp_path / 'cache',
+                                                          pointer=tmp_path / 'active.png'))
+    try:
+        response = web_uploader.app.test_client().post('/set_image', data={'submit_button': 'clicked',
+                                                                           'prepared_key': '0' * 64})
+        assert response.status_code == 404
+    finally:
+        server.shutdown()
+        server.server_close()
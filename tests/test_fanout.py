@@ -0,0 +1,68 @@
+from datetime import datetime
+
+import numpy as np
+import pytest
+from PIL import Image
+
+import frame
+import main
+from benchmark import FakeOWM, FakeWeather
+from weather_provider import WeatherProvider
+
+# renders real text, so it needs the Lato faces in fonts/ that the display uses
+pytestmark = pytest.mark.skipif(not (main.cwd_root / 'fonts' / 'Lato-Regular.ttf').exists(),
+                                reason='fonts/ is not in the repository')
+
+coords = (52.23, 21.01)
+day = datetime(2026, 6, 21)
+# before sunrise, mid day, the last hour before sunset, evening
+times = [day.replace(hour=4, minute=30), day.replace(hour=12), day.replace(hour=19, minute=20),
+         day.replace(hour=22, minute=30)]
+
+
+@pytest.fixture
+def weather(monkeypatch):
+    monkeypatch.setattr(main, 'weather', WeatherProvider(FakeOWM(FakeWeather(day)), cache_path=None))
+    main.weather.refresh(coords)
+
+
+def papierek_frame(bg, bright, time_now):
+    papierek = main.Papierek(coords=coords)
+    papierek.inky_display = None
+    papierek.set_bg(bg, bright)
+    papierek.update_canvas(time_now)
+    return np.asarray(papierek.canvas)
+
+
+def noise(seed, bright):
+    # a dithered looking background, mostly white on a bright one and mostly black on a dark one
+    values = np.random.default_rng(seed).choice(3, size=(300, 400), p=(0.7, 0.2, 0.1) if bright else (0.2, 0.7, 0.1))
+    img = Image.fromarray(values.astype(np.uint8), 'P')
+    img.putpalette(frame.palette)
+    return img
+
+
+@pytest.mark.parametrize('bright', (True, False))
+@pytest.mark.parametrize('time_now', times)
+def test_background_override_matches_papierek(weather, bright, time_now):
+    from fanout import FrameServer
+
+    bg = noise(int(bright), bright)
+    bg_key = ('1' if bright else '0') * 64
+    server = FrameServer(None)
+    server.backgrounds[bg_key] = (np.asarray(bg), bright)
+    packed, _ = server.frame(coords, int(time_now.timestamp()) // 60, bg_key)
+    assert np.array_equal(frame.indices(packed), papierek_frame(bg, bright, time_now))
+
+
+@pytest.mark.parametrize('time_now', times)
+def test_themes(weather, time_now):
+    from fanout import FrameServer
+
+    server = FrameServer(None)
+    minute = int(time_now.timestamp()) // 60
+    plain, _ = server.frame(coords, minute)
+    assert np.array_equal(frame.indices(plain), papierek_frame(None, True, time_now))
+    dark, _ = server.frame(coords, minute, bright=False)
+    # white text on black, whatever the time of day
+    assert np.count_nonzero(frame.indices(dark) == 1) > np.count_nonzero(frame.indices(dark) == 0)
@@ -0,0 +1,19 @@
+import frame
+from frame_log import FrameLog
+
+
+def test_a_log_started_over_gets_a_new_epoch(tmp_path):
+    path = tmp_path / 'frame_log.bin'
+    log = FrameLog.create(path, slots=4)
+    log.append(bytes(frame.frame_bytes))
+
+    # reopened as it is: same epoch, frames carry on
+    assert FrameLog.create(path, slots=4).epoch == log.epoch
+    assert FrameLog.open(path).epoch == log.epoch
+
+    # another shape, or the file gone: counts from 1 again under another epoch
+    started_over = FrameLog.create(path, slots=8)
+    assert started_over.count() == 0
+    assert started_over.epoch != log.epoch
+    path.unlink()
+    assert FrameLog.create(path, slots=8).epoch != started_over.epoch
@@ -0,0 +1,26 @@
+import pytest
+from PIL import Image, ImageDraw
+
+import layout
+
+# measures with the Lato faces the display uses, which are kept out of the repository
+pytestmark = pytest.mark.skipif(not (layout.cwd_root / 'fonts' / 'Lato-Regular.ttf').exists(),
+                                reason='fonts/ is not in the repository')
+
+
+def test_every_row_fits_the_panel():
+    checked, _, overflowing = layout.check()
+    assert checked > 0
+    assert overflowing == []
+
+
+@pytest.mark.parametrize('bold', (False, True))
+def test_text_size_holds_the_whole_rendering(bold):
+    # nothing of a 1-bit rendering may fall outside the mask it is drawn into
+    for size in range(layout.smallest, 61):
+        font = layout.load_font(layout.font_face(bold), size)
+        for text in ('Słońce zajdzie za 23 minuty', '-12,7°C*', '23:59', 'wilgotno wilgotno (84%)'):
+            w, h = layout.text_size(font, text)
+            mask = Image.new('1', (w + 20, h + 20))
+            ImageDraw.Draw(mask).text((0, 0), text, font=font, fill=1)
+            assert mask.crop((0, 0, w, h)).histogram()[-1] == mask.histogram()[-1], (text, size)
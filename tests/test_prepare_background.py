@@ -0,0 +1,35 @@
+import pytest
+
+from benchmark import legacy_prepare_background, synthetic_image
+from prepare_background import prepare_background, visual_difference, visual_tolerance
+
+
+@pytest.mark.parametrize('level', (0.3, 1.0, 1.4))
+def test_downscale_first_looks_like_full_resolution(tmp_path, level):
+    src = tmp_path / f'{level}.jpg'
+    synthetic_image((1200, 900), level).save(src, quality=90)
+
+    legacy, legacy_bright = legacy_prepare_background(src)
+    prepared, bright = prepare_background(src)
+
+    assert bright == legacy_bright
+    assert prepared.size == legacy.size
+    assert visual_difference(legacy, prepared) <= visual_tolerance
+
+
+def test_default_quantizer_goes_through_the_lookup_table(tmp_path, monkeypatch):
+    import prepare_colourspace
+
+    tables = []
+    lookup = prepare_colourspace.lookup
+
+    def spy(rgb, lut, bits=prepare_colourspace.lut_bits):
+        tables.append(lut)
+        return lookup(rgb, lut, bits)
+
+    monkeypatch.setattr(prepare_colourspace, 'lookup', spy)
+    src = tmp_path / 'bg.jpg'
+    synthetic_image((1200, 900), 1.0).save(src, quality=90)
+    prepare_background(src)
+
+    assert any(lut is prepare_colourspace.lab_lut(prepare_colourspace.lut_bits) for lut in tables)
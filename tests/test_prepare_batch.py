@@ -0,0 +1,33 @@
+import pytest
+
+from prepare_batch import plan
+
+
+def touch(path):
+    path.parent.mkdir(parents=True, exist_ok=True)
+    path.write_bytes(b'')
+
+
+def test_same_names_in_different_places_get_their_own_outputs(tmp_path):
+    for name in ('a/x.jpg', 'b/x.jpg', 'a/y.jpg', 'a/y.png'):
+        touch(tmp_path / 'in' / name)
+    jobs = plan([str(tmp_path / 'in')], tmp_path / 'out')
+    outputs = [path for _, path in jobs]
+    assert len(jobs) == 4
+    assert len(set(outputs)) == 4
+    assert tmp_path / 'out' / 'a' / 'x.jpg.png' in outputs
+
+
+def test_globs_keep_the_directories_below_the_pattern(tmp_path):
+    for name in ('a/x.jpg', 'b/x.jpg'):
+        touch(tmp_path / 'in' / name)
+    jobs = plan([str(tmp_path / 'in' / '*' / '*.jpg')], tmp_path / 'out')
+    assert sorted(path for _, path in jobs) == [tmp_path / 'out' / 'a' / 'x.jpg.png',
+                                               tmp_path / 'out' / 'b' / 'x.jpg.png']
+
+
+def test_inputs_writing_the_same_output_are_refused(tmp_path):
+    touch(tmp_path / 'a' / 'x.jpg')
+    touch(tmp_path / 'b' / 'x.jpg')
+    with pytest.raises(ValueError, match='overwrite'):
+        plan([str(tmp_path / 'a'), str(tmp_path / 'b')], tmp_path / 'out')
@@ -0,0 +1,70 @@
+from datetime import datetime
+
+from scheduler import TickScheduler
+
+
+class FakeClock():
+    # monotonic and wall clock that only move when something sleeps or works
+    def __init__(self, wall):
+        self.mono = 1000.0
+        self.offset = wall - self.mono
+        self.sleeps = []
+
+    def clock(self):
+        return self.mono
+
+    def wall(self):
+        return self.mono + self.offset
+
+    def sleep(self, seconds):
+        self.sleeps.append(seconds)
+        self.mono += seconds
+
+    def work(self, seconds):
+        self.mono += seconds
+
+
+def scheduler(clock, **kwargs):
+    return TickScheduler(clock=clock.clock, wall=clock.wall, sleep=clock.sleep, **kwargs)
+
+
+def test_renders_lead_seconds_early_and_shows_on_the_boundary():
+    clock = FakeClock(wall=600 * 60 + 12.5)
+    events = []
+    scheduler(clock, lead=5, refresh_every=1).tick(
+        lambda time_now: events.append(('render', clock.wall(), time_now)),
+        lambda: events.append(('show', clock.wall())))
+
+    boundary = 601 * 60
+    assert events == [('render', boundary - 5, datetime.fromtimestamp(boundary)), ('show', boundary)]
+
+
+def test_shows_only_every_refresh_every_ticks():
+    clock = FakeClock(wall=600 * 60)
+    renders, shows = [], []
+    tick = scheduler(clock, refresh_every=3)
+    for _ in range(9):
+        tick.tick(renders.append, lambda: shows.append(clock.wall()))
+
+    assert len(renders) == 9
+    assert [wall // 60 % 3 for wall in shows] == [0, 0, 0]
+    assert [b - a for a, b in zip(shows, shows[1:])] == [180, 180]
+
+
+def test_overrun_does_not_spin_or_fall_behind():
+    clock = FakeClock(wall=600 * 60)
+    shows = []
+
+    def slow_render(time_now):
+        clock.work(70)  # longer than the lead and the whole period
+
+    tick = scheduler(clock, lead=5, refresh_every=1)
+    tick.tick(slow_render, lambda: shows.append(clock.wall()))
+    sleeps = len(clock.sleeps)
+    tick.tick(lambda time_now: None, lambda: shows.append(clock.wall()))
+
+    # the late show goes out right away, the next tick waits for the next real boundary
+    assert shows[0] == 601 * 60 + 65
+    assert shows[1] == 603 * 60
+    assert len(clock.sleeps) - sleeps <= 2
+    assert all(seconds > 0 for seconds in clock.sleeps)
@@ -0,0 +1,108 @@
+#!/usr/bin/env python3
+
+import json
+import os
+import threading
+from collections import namedtuple
+from pathlib import Path
+from sys import stderr
+from time import time
+
+import metrics
+
+cwd_root = Path(__file__).parent.absolute()
+
+# the parts of an OWM observation Papierek draws, plus whether the last refresh failed
+Observation = namedtuple('Observation', ['reception_time', 'reference_time', 'sunrise_time', 'sunset_time',
+                                         'detailed_status', 'temperature', 'humidity', 'fetched', 'stale'])
+
+
+class WeatherProvider():
+    # OWM updates about every 10 minutes, there is no point in asking more often
+    ttl = 10 * 60
+
+    def __init__(self, owm, cache_path=cwd_root / 'weather_cache.json', ttl=None, precision=2):
+        self.owm = owm
+        self.cache_path = cache_path
+        self.ttl = ttl or self.ttl
+        self.precision = precision
+        self.lock = threading.Lock()
+        self.refreshing = set()
+        self.failed = set()
+        self.observations = self.load()
+
+    def key(self, coords):
+        lat, lon = coords
+        return f'{round(lat, self.precision)},{round(lon, self.precision)}'
+
+    def get(self, coords):
+        # never waits for the network: returns what is cached (or None) and refreshes in the background
+        key = self.key(coords)
+        with self.lock:
+            entry = self.observations.get(key)
+            stale = key in self.failed
+        if entry is None or time() - entry['fetched'] > self.ttl:
+            self.refresh_async(coords)
+        else:
+            metrics.inc('weather_cache_hits')
+        if entry is None:
+            return None
+        return Observation(stale=stale, **entry)
+
+    def refresh_async(self, coords):
+        key = self.key(coords)
+        with self.lock:
+            if key in self.refreshing:
+                return
+            self.refreshing.add(key)
+        threading.Thread(target=self.refresh, args=(coords,), daemon=True).start()
+
+    def refresh(self, coords):
+        key = self.key(coords)
+        try:
+            metrics.inc('owm_api_calls')
+            with metrics.timed('owm_weather_at_coords'):
+                observation = self.owm.weather_at_coords(*coords)
+            weather = observation.get_weather()
+            entry = {
+                'reception_time': observation.get_reception_time(),
+                'reference_time': weather.get_reference_time(),
+                'sunrise_time': weather.get_sunrise_time(),
+                'sunset_time': weather.get_sunset_time(),
+                'detailed_status': weather.get_detailed_status(),
+                'temperature': weather.get_temperature(unit='celsius')['temp'],
+                'humidity': weather.get_humidity(),
+                'fetched': time(),
+            }
+            with self.lock:
+                self.observations[key] = entry
+                self.failed.discard(key)
+            self.save()
+        except Exception as e:
+            # keep serving whatever we had, marked as stale
+            print(f'weather refresh failed: {e}', file=stderr)
+            metrics.inc('owm_api_errors')
+            with self.lock:
+                self.failed.add(key)
+        finally:
+            with self.lock:
+                self.refreshing.discard(key)
+
+    def load(self):
+        if not self.cache_path:
+            return {}
+        try:
+            with open(self.cache_path) as f:
+                return json.load(f)
+        except (OSError, ValueError):
+            return {}
+
+    def save(self):
+        if not self.cache_path:
+            return
+        with self.lock:
+            data = json.dumps(self.observations)
+        tmp_path = f'{self.cache_path}.tmp'
+        with open(tmp_path, 'w') as f:
+            f.write(data)
+        os.replace(tmp_path, self.cache_path)
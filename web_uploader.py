@@ -1,15 +1,50 @@
 import os
+import re
+import threading
+from datetime import datetime
+from concurrent.futures import ProcessPoolExecutor
+from io import BytesIO
 from pathlib import Path
+from uuid import uuid4
 
-from PIL import Image
-from flask import Flask, render_template, request, redirect, url_for
+from PIL import Image, UnidentifiedImageError
+from flask import Flask, Request, render_template, request, redirect, url_for, jsonify, abort, send_file
 from werkzeug.utils import secure_filename
 
-import prepare_colourspace
-from prepare_brightness import threshold, get_modified, percv_brightness
+import control
+import frame
+import metrics
+from frame_log import FrameLog
+from prepare_cache import cached_prepare, cached_path, activate
 
 cwd_root = Path(__file__).parent.absolute()
+uploads_dir = cwd_root / 'static' / 'uploads'
+
+
+class UploadRequest(Request):
+    # file parts are written into static/uploads as the multipart parser reads them, instead of
+    # a spooled temporary file that would be copied there afterwards
+    def _get_file_stream(self, total_content_length, content_type, filename=None, content_length=None):
+        path = uploads_dir / f'{uuid4().hex}.part'
+        self.part_paths.append(path)
+        return open(path, 'w+b')
+
+    @property
+    def part_paths(self):
+        return self.__dict__.setdefault('_part_paths', [])
+
+
 app = Flask(__name__)
+app.request_class = UploadRequest
+app.config['PREPARE_WORKERS'] = int(os.environ.get('CLOUDINK_PREPARE_WORKERS', 1))
+app.config['PREPARE_QUEUE_DEPTH'] = int(os.environ.get('CLOUDINK_PREPARE_QUEUE_DEPTH', 4))
+app.config['MAX_CONTENT_LENGTH'] = int(os.environ.get('CLOUDINK_MAX_UPLOAD_MB', 25)) * 1024 * 1024
+# let a fronting nginx/lighttpd do the sendfile() of prepared frames
+app.config['USE_X_SENDFILE'] = os.environ.get('CLOUDINK_X_SENDFILE', '') == '1'
+
+executor = None
+jobs = {}  # job id -> Future of prepare_job
+jobs_lock = threading.Lock()  # request threads and executor callbacks both get at jobs
 
 
 @app.route('/')
@@ -20,83 +55,222 @@ def index():
 @app.route('/set_image', methods=['POST'])
 def set_image():
     if request.form['submit_button'] == 'clicked':
-        rel_src = request.form['img_rel_path']
-
-        from shutil import copyfile
-        src = cwd_root / rel_src
-        new_filename = Path('bg_uploaded' + src.suffix)
-        dst = cwd_root / new_filename
+        key = request.form['prepared_key']
+        if not re.fullmatch('[0-9a-f]{64}', key):
+            abort(400)
+        if not cached_path(key).exists():
+            # evicted from the cache since the preview was shown
+            abort(404)
+        try:
+            # the display daemon switches and redraws right away
+            control.request('set_bg', key=key)
+        except OSError:
+            # not running, it picks the pointer up when it starts
+            try:
+                activate(key)
+            except FileNotFoundError:
+                abort(404)
 
-        from glob import glob
-        to_deletes = glob(str(dst.parent / new_filename.stem) + '.*')
-        for to_delete in to_deletes:
-            if os.path.exists(to_delete):
-                Path(to_delete).unlink()
+    return redirect(url_for('index'))
 
-        copyfile(src, dst)  # save it in root
 
+@app.route('/refresh', methods=['POST'])
+def refresh():
+    try:
+        control.request('render')
+    except OSError:
+        return render_template('uploader.html', error='Ekranik nie odpowiada'), 503
     return redirect(url_for('index'))
 
 
+@app.route('/screen.png')
+def screen():
+    # what is on the panel now, read from the daemon's frame log
+    log = FrameLog.open()
+    record = log and log.latest()
+    if record is None:
+        # no log (yet), ask the daemon for what it rendered last
+        try:
+            reply, png = control.request('frame')
+        except OSError:
+            abort(503)
+        return send_file(BytesIO(png), mimetype='image/png', max_age=0)
+    return frame_png(record, log.epoch, max_age=0)
+
+
+@app.route('/screen/<epoch>/<int:seq>.png')
+def screen_frame(epoch, seq):
+    # an old frame never changes, only drops out of the ring. a log started over counts from 1
+    # again under a new epoch, so the same URL never means another frame
+    log = FrameLog.open()
+    record = log and epoch == f'{log.epoch:016x}' and log.get(seq)
+    if not record:
+        abort(404)
+    response = frame_png(record, log.epoch, max_age=365 * 24 * 60 * 60)
+    response.cache_control.immutable = True
+    return response
+
+
+@app.route('/screen/history')
+def screen_history():
+    log = FrameLog.open()
+    frames = [(seq, datetime.fromtimestamp(when)) for seq, when, _ in (log.history(48) if log else [])]
+    return render_template('history.html', frames=frames, epoch=log and f'{log.epoch:016x}')
+
+
+def frame_png(record, epoch, max_age):
+    # PNG of a logged frame; a browser that has this one already gets a 304 before anything is encoded
+    seq, when, packed = record
+    etag = f'frame-{epoch:016x}-{seq}'
+    if request.if_none_match.contains(etag):
+        response = app.response_class(status=304)
+    else:
+        png = BytesIO()
+        frame.unpack(packed).save(png, 'PNG')
+        response = app.response_class(png.getvalue(), mimetype='image/png')
+    response.set_etag(etag)
+    response.cache_control.max_age = max_age
+    return response
+
+
+@app.route('/prepared/<key>.png')
+def prepared(key):
+    # content addressed, so it never changes: let the browser keep it for good
+    if not re.fullmatch('[0-9a-f]{64}', key) or not cached_path(key).exists():
+        # unknown, or evicted while the link was still around
+        abort(404)
+    response = send_file(cached_path(key), mimetype='image/png', conditional=True, etag=key,
+                         max_age=365 * 24 * 60 * 60)
+    response.cache_control.public = True
+    response.cache_control.immutable = True
+    return response
+
+
+@app.errorhandler(413)
+def too_large(e):
+    limit = app.config['MAX_CONTENT_LENGTH'] // (1024 * 1024)
+    return render_template('uploader.html', error=f'Za duży plik, najwyżej {limit} MB'), 413
+
+
 @app.route('/upload', methods=['POST'])
 def upload():
-    abs_path = None
-    success = False
-    error = None
+    # turned away before the body is read, and once more when it is queued: another upload may
+    # have taken the last place in between
+    with jobs_lock:
+        full = queue_full()
+    if full:
+        return queue_full_page()
+
     try:
         file_obj = request.files['file']
-        mime = file_obj.mimetype
-        type, subtype = mime.split('/')
-        if type != 'image':
-            error = f"Wgraj obrazek, a nie jakiś szajs ({subtype} ???)"
-            raise
         original_filename = secure_filename(file_obj.filename)
-        from datetime import datetime
-        filename_part = int(datetime.now().timestamp())
-        filename = Path(str(filename_part) + Path(original_filename).suffix)
-        abs_path = cwd_root / Path('static') / Path('uploads')
-        file_obj.save(str(abs_path / filename))
-        success = True
-    except:
-        raise
+        job_id = uuid4().hex
+        filename = Path(job_id + Path(original_filename).suffix)
+        # already on disk next to where it belongs, the name is all that changes
+        file_obj.stream.close()
+        os.replace(file_obj.stream.name, uploads_dir / filename)
     finally:
-        # return render_template('uploaded.html', success=success, image_path=abs_path, error=error)
-        prepared = prepare_image(abs_path / filename)
-        filename_prepared = Path(str(filename_part) + '.png')
-        prepared.save(abs_path / 'prepared' / filename_prepared, 'PNG')
-        # return send_file(prepared, mimetype=mime)
-        return render_template('uploaded.html',
-                               rel_img_path=str(Path('static') / Path('uploads') / 'prepared' / filename_prepared),
-                               rel_return_img_path=str(Path('static') / Path('uploads') / filename))
+        # whatever the parser left half written, or that never got its name
+        for path in request.part_paths:
+            path.unlink(missing_ok=True)
+
+    # trust the header, not the mimetype the browser made up. no pixels are decoded here,
+    # prepare_background decodes at reduced resolution later on
+    try:
+        with Image.open(uploads_dir / filename) as im:
+            im.verify()
+    except (UnidentifiedImageError, Image.DecompressionBombError, OSError, SyntaxError):
+        (uploads_dir / filename).unlink()
+        return render_template('uploader.html',
+                               error=f"Wgraj obrazek, a nie jakiś szajs ({file_obj.mimetype} ???)"), 415
+
+    with jobs_lock:
+        if queue_full():
+            (uploads_dir / filename).unlink()
+            return queue_full_page()
+        forget_finished_jobs()
+        job = jobs[job_id] = get_executor().submit(prepare_job, uploads_dir / filename)
+    job.add_done_callback(collect_job_metrics)
+    metrics.inc('uploads')
+    return redirect(url_for('uploaded', job_id=job_id))
+
+
+@app.route('/status/<job_id>')
+def status(job_id):
+    with jobs_lock:
+        job = jobs.get(job_id)
+    if job is None:
+        abort(404)
+    return jsonify(job_id=job_id, state=job_state(job))
+
 
+@app.route('/uploaded/<job_id>')
+def uploaded(job_id):
+    with jobs_lock:
+        job = jobs.get(job_id)
+    if job is None:
+        abort(404)
+    state = job_state(job)
+    if state == 'failed':
+        return render_template('uploader.html', error=f'Nie udało się przygotować obrazka ({job.exception()})'), 500
+    if state != 'done':
+        return render_template('preparing.html', job_id=job_id, state=state)
+    return render_template('uploaded.html',
+                           rel_img_path=url_for('prepared', key=job.result()[0]),
+                           prepared_key=job.result()[0])
 
-def save_prepared(prepared_im):
-    filename = 'bg_prepared.png'
-    prepared_im.save(cwd_root / filename, 'PNG')
 
+def get_executor():
+    global executor
+    if executor is None:
+        executor = ProcessPoolExecutor(max_workers=app.config['PREPARE_WORKERS'])
+    return executor
 
-def prepare_image(im_filename):
-    # oh, there is a image.
-    # threshold it and then:
-    # - if it is dark, then make it even darker
-    # - if it is bright, make it brighter
-    bg = Image.open(im_filename)
 
-    print(f'input brightness: {percv_brightness(bg)}')
-    if_brighter = threshold(bg)
-    bg_1_stage = get_modified(bg, if_brighter)
+def job_state(job):
+    if job.running():
+        return 'running'
+    if not job.done():
+        return 'queued'
+    return 'failed' if job.exception() else 'done'
 
-    # transform to eink colourspace
 
-    bg_2_stage = prepare_colourspace.prepare(bg_1_stage)
+def queue_full():
+    # with jobs_lock held
+    return sum(not job.done() for job in jobs.values()) >= app.config['PREPARE_QUEUE_DEPTH']
 
-    # bg_2_stage.putpalette((190, 190, 190, 25, 25, 25, 150, 20, 60) + (0, 0, 0) * 252)
 
-    # img_io = BytesIO()
-    # bg_2_stage.save(img_io, 'PNG', quality=70)
-    # img_io.seek(0)
-    # return img_io
-    return bg_2_stage
+def queue_full_page():
+    return render_template('uploader.html', error='Za dużo obrazków naraz, spróbuj za chwilę'), 503
+
+
+def forget_finished_jobs(keep=100):
+    # with jobs_lock held
+    finished = [job_id for job_id, job in jobs.items() if job.done()]
+    for job_id in finished[:-keep]:
+        del jobs[job_id]
+
+
+def prepare_job(src):
+    # runs in a worker process, returns the cache key of the prepared frame and the worker's metrics
+    _, _, key = cached_prepare(src)
+    return key, metrics.drain()
+
+
+def collect_job_metrics(job):
+    if not job.exception():
+        metrics.merge(job.result()[1])
+
+
+@app.route('/metrics')
+def metrics_endpoint():
+    snapshots = {'uploader': metrics.snapshot()}
+    try:
+        reply, _ = control.request('metrics', timeout=2)
+        snapshots['display'] = reply['metrics']
+    except OSError:
+        pass  # display daemon not running
+    return metrics.render_prometheus(snapshots), 200, {'Content-Type': 'text/plain; version=0.0.4'}
 
 
 if __name__ == '__main__':